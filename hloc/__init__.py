@@ -1,4 +1,13 @@
 import logging
+try:
+    from importlib.metadata import version as package_version
+    from importlib.metadata import PackageNotFoundError
+except ImportError:  # Python<3.8
+    from pkg_resources import get_distribution
+    from pkg_resources import DistributionNotFound as PackageNotFoundError
+
+    def package_version(name):
+        return get_distribution(name).version
 from packaging import version
 
 __version__ = '1.3'
@@ -15,13 +24,15 @@ logger.setLevel(logging.INFO)
 logger.addHandler(handler)
 logger.propagate = False
 
+# Check the version from the package metadata, since importing pycolmap is
+# slow and not needed by all the modules.
 try:
-    import pycolmap
-except ImportError:
+    found_version = package_version('pycolmap')
+except PackageNotFoundError:
     logger.warning('pycolmap is not installed, some features may not work.')
 else:
     minimal_version = version.parse('0.2.0')
-    found_version = version.parse(getattr(pycolmap, '__version__'))
+    found_version = version.parse(found_version)
     if found_version < minimal_version:
         logger.warning(
             'hloc now requires pycolmap>=%s but found pycolmap==%s, '
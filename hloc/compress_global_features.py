@@ -0,0 +1,142 @@
+import argparse
+from pathlib import Path
+from typing import Dict, List, Optional
+import h5py
+import numpy as np
+from tqdm import tqdm
+
+from . import logger
+from .utils.io import (
+    list_h5_names, expand_h5_paths, read_array, read_stacked, FeatureWriter)
+
+KEY = 'global_descriptor'
+EPS = 1e-6
+
+
+def pca_path(descriptors: Path) -> Path:
+    '''The PCA-whitening is stored alongside the descriptors it was fit on.'''
+    return descriptors.parent / (descriptors.stem + '.pca.npz')
+
+
+def fit(descriptors: Path, output: Optional[Path] = None,
+        max_dim: int = 1024, num_samples: int = 20000) -> Path:
+    '''Fit a PCA-whitening on (a random subset of) reference descriptors.'''
+    name2path = {n: p for p in expand_h5_paths(descriptors)
+                 for n in list_h5_names(p)}
+    names = list(name2path)
+    if len(names) > num_samples:
+        rng = np.random.RandomState(0)
+        names = sorted(rng.choice(names, num_samples, replace=False))
+    logger.info('Fitting the PCA-whitening on %d descriptors.', len(names))
+    desc = read_stacked(
+        names, [name2path[n] for n in names], KEY).astype(np.float32)
+    mean = desc.mean(0)
+    desc = (desc - mean).astype(np.float64)
+    cov = desc.T @ desc / len(desc)
+    eigvals, eigvecs = np.linalg.eigh(cov)
+    order = np.argsort(-eigvals)[:max_dim]
+
+    if output is None:
+        output = pca_path(Path(descriptors))
+    np.savez(str(output), mean=mean,
+             components=eigvecs[:, order].T.astype(np.float32),
+             eigvals=eigvals[order].astype(np.float32))
+    logger.info('Wrote the PCA-whitening to %s.', output)
+    return output
+
+
+def load(path: Path) -> Dict[str, np.ndarray]:
+    with np.load(str(path)) as pca:
+        return {k: pca[k] for k in pca.files}
+
+
+def project(desc: np.ndarray, pca: Dict[str, np.ndarray],
+            dim: int) -> np.ndarray:
+    '''Project and whiten descriptors of shape ... x D to ... x dim.'''
+    if dim > len(pca['components']):
+        raise ValueError(f'The PCA has only {len(pca["components"])} '
+                         f'dimensions, cannot project to {dim}.')
+    scale = 1 / np.sqrt(pca['eigvals'][:dim] + EPS)
+    weights = pca['components'][:dim] * scale[:, None]
+    desc = (desc.astype(np.float32) - pca['mean']) @ weights.T
+    return desc / (np.linalg.norm(desc, axis=-1, keepdims=True) + EPS)
+
+
+def apply(descriptors: Path, pca: Path, dim: int,
+          output: Optional[Path] = None, as_half: bool = True) -> Path:
+    '''Write the compressed descriptors to a new file, one image at a time.
+    The output can be given directly to pairs_from_retrieval, with
+    min_score=None since the descriptors are mean-centred.'''
+    pca_ = load(pca)
+    if output is None:
+        output = descriptors.parent / f'{descriptors.stem}-pca{dim}.h5'
+    paths = expand_h5_paths(descriptors)
+    with FeatureWriter(output) as writer:
+        for path in paths:
+            with h5py.File(str(path), 'r') as fd:
+                for name in tqdm(list_h5_names(path)):
+                    desc = project(read_array(fd[name][KEY]), pca_, dim)
+                    if as_half:
+                        desc = desc.astype(np.float16)
+                    writer.write(name, {KEY: desc})
+    logger.info('Wrote the %d-d descriptors to %s.', dim, output)
+    return output
+
+
+def report(descriptors: Path, pca: Path, dims: List[int], k: int = 10,
+           num_queries: int = 1000):
+    '''Recall@k of the retrieval with compressed descriptors, with the
+    neighbors retrieved with the full descriptors as ground truth.'''
+    name2path = {n: p for p in expand_h5_paths(descriptors)
+                 for n in list_h5_names(p)}
+    names = list(name2path)
+    desc = read_stacked(
+        names, [name2path[n] for n in names], KEY).astype(np.float32)
+    k = min(k, len(names) - 1)  # no self-retrieval
+    rng = np.random.RandomState(0)
+    queries = rng.choice(len(names), min(num_queries, len(names)),
+                         replace=False)
+
+    def topk(db, chunk_size=128):
+        indices = []
+        for chunk in np.array_split(
+                queries, max(len(queries) // chunk_size, 1)):
+            sim = db[chunk] @ db.T
+            sim[np.arange(len(chunk)), chunk] = -np.inf  # no self-retrieval
+            indices.append(np.argpartition(-sim, k, axis=1)[:, :k])
+        return np.concatenate(indices)
+
+    gt = topk(desc)
+    pca_ = load(pca)
+    recalls = {}
+    for dim in dims:
+        pred = topk(project(desc, pca_, dim))
+        recalls[dim] = np.mean([len(np.intersect1d(p, g)) / k
+                                for p, g in zip(pred, gt)])
+        logger.info('dim %4d: recall@%d %.3f, %.1f MB per 1M images',
+                    dim, k, recalls[dim], dim * 2)
+    return recalls
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--descriptors', type=Path, required=True)
+    parser.add_argument('--dim', type=int, default=256)
+    parser.add_argument('--output', type=Path)
+    parser.add_argument('--reference', type=Path,
+                        help='Descriptors to fit on, by default --descriptors')
+    parser.add_argument('--pca', type=Path,
+                        help='Existing PCA-whitening, otherwise it is fit')
+    parser.add_argument('--num_samples', type=int, default=20000)
+    parser.add_argument('--report', type=int, nargs='+',
+                        help='Report the recall for these dimensions')
+    args = parser.parse_args()
+
+    pca = args.pca
+    if pca is None:
+        pca = fit(args.reference or args.descriptors,
+                  num_samples=args.num_samples)
+    if args.report:
+        report(args.descriptors, pca, args.report)
+    else:
+        apply(args.descriptors, pca, args.dim, args.output)
@@ -1,21 +1,30 @@
 import argparse
+import math
+import re
+import time
 import torch
 from pathlib import Path
-from typing import Dict, List, Union, Optional
-import h5py
+from typing import Dict, List, Union, Optional, Tuple
 from types import SimpleNamespace
 import cv2
 import numpy as np
 from tqdm import tqdm
 import pprint
+from collections import defaultdict
 import collections.abc as collections
-import PIL.Image
 
-from . import extractors, logger
-from .utils.base_model import dynamic_load
+from . import extractors, logger, __version__
+from .utils.base_model import get_model
 from .utils.tools import map_tensor
 from .utils.parsers import parse_image_lists
-from .utils.io import read_image, list_h5_names
+from .utils.io import (
+    read_image, read_image_size, list_h5_names, FeatureWriter,
+    quantize_descriptors, shard_of, shard_path, mark_shard,
+    manifest_path, write_manifest, storage_profiles)
+from .utils.cache import ExtractionCache, hash_file
+from . import compress_global_features
+
+default_collate = torch.utils.data.dataloader.default_collate
 
 
 '''
@@ -24,6 +33,13 @@ line using their name. Each is a dictionary with the following entries:
     - output: the name of the feature file that will be generated.
     - model: the model configuration, as passed to a feature extractor.
     - preprocessing: how to preprocess the images read from disk.
+    - loader (optional): how many processes decode and preprocess images in
+      parallel (num_workers) and how many images each of them prefetches
+      (prefetch_factor), see default_loader_conf.
+    - tiling (optional): run a local feature extractor on overlapping tiles
+      of large images instead of the full image, see default_tiling_conf.
+    - pca (optional): compress the global descriptors to `dim` dimensions
+      with the PCA-whitening stored at `path`, see compress_global_features.
 '''
 confs = {
     'superpoint_aachen': {
@@ -108,6 +124,34 @@ confs = {
             'resize_max': 1600,
         },
     },
+    # Optimized for CPU-only machines, see utils.inference.
+    'superpoint_aachen_cpu': {
+        'output': 'feats-superpoint-n4096-r1024',
+        'model': {
+            'name': 'superpoint',
+            'nms_radius': 3,
+            'max_keypoints': 4096,
+            'cpu': {'channels_last': True},
+        },
+        'preprocessing': {
+            'grayscale': True,
+            'resize_max': 1024,
+        },
+    },
+    # int8 quantization calibrated on the images to extract.
+    'superpoint_aachen_int8': {
+        'output': 'feats-superpoint-n4096-r1024-int8',
+        'model': {
+            'name': 'superpoint',
+            'nms_radius': 3,
+            'max_keypoints': 4096,
+            'int8': {'num_images': 32},
+        },
+        'preprocessing': {
+            'grayscale': True,
+            'resize_max': 1024,
+        },
+    },
     # Global descriptors
     'dir': {
         'output': 'global-feats-dir',
@@ -119,6 +163,22 @@ confs = {
         'model': {'name': 'netvlad'},
         'preprocessing': {'resize_max': 1024},
     },
+    'netvlad_cpu': {
+        'output': 'global-feats-netvlad',
+        'model': {
+            'name': 'netvlad',
+            'cpu': {'channels_last': True},
+        },
+        'preprocessing': {'resize_max': 1024},
+    },
+    'netvlad_int8': {
+        'output': 'global-feats-netvlad-int8',
+        'model': {
+            'name': 'netvlad',
+            'int8': {'num_images': 32},
+        },
+        'preprocessing': {'resize_max': 1024},
+    },
     'openibl': {
         'output': 'global-feats-openibl',
         'model': {'name': 'openibl'},
@@ -127,6 +187,16 @@ confs = {
 }
 
 
+default_tiling_conf = {
+    'tile_size': 1024,
+    'overlap': 128,
+}
+default_loader_conf = {
+    'num_workers': 1,
+    'prefetch_factor': 2,
+}
+
+
 def resize_image(image, size, interp):
     if interp.startswith('cv2_'):
         interp = getattr(cv2, 'INTER_'+interp[len('cv2_'):].upper())
@@ -135,6 +205,7 @@ def resize_image(image, size, interp):
             interp = cv2.INTER_LINEAR
         resized = cv2.resize(image, size, interpolation=interp)
     elif interp.startswith('pil_'):
+        import PIL.Image
         interp = getattr(PIL.Image, interp[len('pil_'):].upper())
         resized = PIL.Image.fromarray(image.astype(np.uint8))
         resized = resized.resize(size, resample=interp)
@@ -145,6 +216,55 @@ def resize_image(image, size, interp):
     return resized
 
 
+def normalize_image(image):
+    '''Convert a HxW or HxWxC image to a CxHxW float array in [0, 1].
+    The output is allocated once and filled without any full-size temporary.
+    '''
+    if image.ndim == 2:
+        image = image[None]
+    else:
+        image = image.transpose((2, 0, 1))  # HxWxC to CxHxW
+    normalized = np.empty(image.shape, dtype=np.float32)
+    np.divide(image, np.float32(255.), out=normalized, dtype=np.float32)
+    return normalized
+
+
+def decode_reduction(size, resize_max):
+    '''Largest JPEG decoding reduction that does not go below resize_max.'''
+    for reduction in [8, 4, 2]:
+        if math.ceil(max(size) / reduction) >= resize_max:
+            return reduction
+    return 1
+
+
+def load_image(path, conf):
+    '''Read an image, possibly at a reduced resolution, and its size.'''
+    reduction = 1
+    if (conf.reduced_decode and conf.resize_max
+            and path.suffix.lower() in ['.jpg', '.jpeg']):
+        size = read_image_size(path)
+        reduction = decode_reduction(size, conf.resize_max)
+    image = read_image(path, conf.grayscale, reduction)
+    if reduction == 1:
+        size = image.shape[:2][::-1]
+    elif any(abs(x*reduction - y) >= reduction
+             for x, y in zip(image.shape[:2][::-1], size)):
+        # the size in the header is inconsistent with the decoded image
+        image = read_image(path, conf.grayscale)
+        size = image.shape[:2][::-1]
+    return image, size
+
+
+def preprocess_image(image, size, conf):
+    if conf.resize_max and (conf.resize_force or max(size) > conf.resize_max):
+        scale = conf.resize_max / max(size)
+        size_new = tuple(int(round(x*scale)) for x in size)
+        if not conf.resize_uint8:
+            image = image.astype(np.float32)
+        image = resize_image(image, size_new, conf.interpolation)
+    return normalize_image(image)
+
+
 class ImageDataset(torch.utils.data.Dataset):
     default_conf = {
         'globs': ['*.jpg', '*.png', '*.jpeg', '*.JPG', '*.PNG'],
@@ -152,6 +272,12 @@ class ImageDataset(torch.utils.data.Dataset):
         'resize_max': None,
         'resize_force': False,
         'interpolation': 'cv2_area',  # pil_linear is more accurate but slower
+        # Decode JPEG images at a reduced resolution that is the closest to
+        # resize_max, faster and lighter but slightly less accurate.
+        'reduced_decode': False,
+        # Resize in uint8 and convert to float only at the target size, which
+        # reduces the peak memory but rounds the resized intensities.
+        'resize_uint8': False,
     }
 
     def __init__(self, root, conf, paths=None):
@@ -183,21 +309,8 @@ class ImageDataset(torch.utils.data.Dataset):
 
     def __getitem__(self, idx):
         name = self.names[idx]
-        image = read_image(self.root / name, self.conf.grayscale)
-        image = image.astype(np.float32)
-        size = image.shape[:2][::-1]
-
-        if self.conf.resize_max and (self.conf.resize_force
-                                     or max(size) > self.conf.resize_max):
-            scale = self.conf.resize_max / max(size)
-            size_new = tuple(int(round(x*scale)) for x in size)
-            image = resize_image(image, size_new, self.conf.interpolation)
-
-        if self.conf.grayscale:
-            image = image[None]
-        else:
-            image = image.transpose((2, 0, 1))  # HxWxC to CxHxW
-        image = image / 255.
+        image, size = load_image(self.root / name, self.conf)
+        image = preprocess_image(image, size, self.conf)
 
         data = {
             'name': name,
@@ -210,86 +323,502 @@ class ImageDataset(torch.utils.data.Dataset):
         return len(self.names)
 
 
+class ImageStream(torch.utils.data.IterableDataset):
+    '''Frames of a video or of a directory of timestamped images, such as
+    cam0/<timestamp>-f.jpg, read in temporal order and subsampled by a frame
+    stride, a minimum time gap, and a minimum image motion. Frames of
+    directories that are dropped by the stride or time gap are never decoded.
+    '''
+    default_conf = {
+        'stride': 1,
+        'min_time_gap': None,  # in seconds
+        'min_motion': None,  # mean absolute difference of thumbnails, 0-255
+        'timestamp_regex': r'\d+',  # first integer of the image name
+        'timestamp_unit': 1e-9,  # nanoseconds
+        'thumbnail_size': (64, 48),
+    }
+    video_extensions = ['.mp4', '.avi', '.mov', '.mkv']
+
+    def __init__(self, source, conf):
+        self.conf = conf = SimpleNamespace(**{
+            **ImageDataset.default_conf, **self.default_conf, **conf})
+        self.source = Path(source)
+        self.skip_names = set()
+        self.is_video = self.source.suffix.lower() in self.video_extensions
+        if self.is_video:
+            if not self.source.exists():
+                raise ValueError(f'Could not find the video {self.source}.')
+            return
+
+        paths = []
+        for g in conf.globs:
+            paths += list(self.source.glob('**/'+g))
+        if len(paths) == 0:
+            raise ValueError(f'Could not find any image in {self.source}.')
+        frames = []
+        for path in set(paths):
+            name = path.relative_to(self.source).as_posix()
+            stamp = re.search(conf.timestamp_regex, path.name)
+            if stamp is None:
+                raise ValueError(f'Could not find a timestamp in {name}.')
+            frames.append((int(stamp.group()) * conf.timestamp_unit, name))
+        frames = sorted(frames)[::conf.stride]
+        if conf.min_time_gap is not None:
+            selected = frames[:1]
+            for t, name in frames[1:]:
+                if t - selected[-1][0] >= conf.min_time_gap:
+                    selected.append((t, name))
+            frames = selected
+        self.frames = frames
+        logger.info(f'Selected {len(self.frames)}/{len(paths)} images '
+                    f'in root {self.source}.')
+
+    def keep_motion(self, image, state):
+        if self.conf.min_motion is None:
+            return True
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        thumbnail = cv2.resize(image, tuple(self.conf.thumbnail_size),
+                               interpolation=cv2.INTER_AREA).astype(np.float32)
+        if state.get('thumbnail') is not None:
+            motion = np.abs(thumbnail - state['thumbnail']).mean()
+            if motion < self.conf.min_motion:
+                return False
+        state['thumbnail'] = thumbnail
+        return True
+
+    def __iter__(self):
+        frames = self.iter_video() if self.is_video else self.iter_images()
+        for name, image, size in frames:
+            yield {
+                'name': name,
+                'image': preprocess_image(image, size, self.conf),
+                'original_size': np.array(size),
+            }
+
+    def iter_images(self):
+        state = {}
+        for _, name in self.frames:
+            path = self.source / name
+            if self.conf.min_motion is not None:
+                # a low-resolution decoding is enough to estimate the motion
+                is_jpeg = path.suffix.lower() in ['.jpg', '.jpeg']
+                thumbnail = read_image(path, True, 8 if is_jpeg else 1)
+                if not self.keep_motion(thumbnail, state):
+                    continue
+            if name in self.skip_names:
+                continue
+            image, size = load_image(path, self.conf)
+            yield name, image, size
+
+    def iter_video(self):
+        video = cv2.VideoCapture(str(self.source))
+        state = {}
+        index = -1
+        last_time = None
+        while True:
+            index += 1
+            if not video.grab():  # demux without color conversion
+                break
+            if index % self.conf.stride != 0:
+                continue
+            t = video.get(cv2.CAP_PROP_POS_MSEC) / 1e3
+            if self.conf.min_time_gap is not None:
+                if last_time is not None and (
+                        t - last_time < self.conf.min_time_gap):
+                    continue
+                last_time = t
+            name = f'{self.source.stem}/{index:06d}'
+            ok, image = video.retrieve()
+            if not ok:
+                break
+            if self.conf.grayscale:
+                image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            else:
+                image = image[:, :, ::-1]  # BGR to RGB
+            if not self.keep_motion(image, state) or name in self.skip_names:
+                continue
+            yield name, image, image.shape[:2][::-1]
+        video.release()
+
+
+def worker_init_fn(_):
+    # Each worker decodes a single image at a time, avoid oversubscription.
+    cv2.setNumThreads(1)
+    torch.set_num_threads(1)
+
+
+def postprocess_prediction(pred, original_size, size, detection_noise,
+                           as_half, quantize=None):
+    attrs = {}
+    pred['image_size'] = original_size
+    if 'keypoints' in pred:
+        scales = (original_size / size).astype(np.float32)
+        pred['keypoints'] = (pred['keypoints'] + .5) * scales[None] - .5
+        # add keypoint uncertainties scaled to the original resolution
+        uncertainty = detection_noise * scales.mean()
+        attrs['keypoints'] = {'uncertainty': uncertainty}
+
+    # Global descriptors are small and sensitive, only quantize local ones.
+    if quantize is not None and 'descriptors' in pred:
+        pred['descriptors'], attrs['descriptors'] = quantize_descriptors(
+            pred['descriptors'], quantize)
+
+    if as_half:
+        for k in pred:
+            dt = pred[k].dtype
+            if (dt == np.float32) and (dt != np.float16):
+                pred[k] = pred[k].astype(np.float16)
+    return pred, attrs
+
+
+def get_tiling_conf(conf: Dict) -> Optional[Dict]:
+    tiling = conf.get('tiling')
+    if tiling is None:
+        return None
+    tiling = {**default_tiling_conf, **tiling}
+    if not 0 <= tiling['overlap'] < tiling['tile_size']:
+        raise ValueError(
+            f'The tile overlap {tiling["overlap"]} must be non-negative and '
+            f'smaller than the tile size {tiling["tile_size"]}.')
+    return tiling
+
+
+def tile_offsets(length: int, tile_size: int, overlap: int):
+    '''Start of the tiles along one dimension and the boundaries of their
+    cores, which partition the dimension at the middle of the overlaps.'''
+    if length <= tile_size:
+        return [0], [0, length]
+    step = tile_size - overlap
+    starts = list(range(0, length - tile_size, step)) + [length - tile_size]
+    bounds = [0] + [(s0 + tile_size + s1) / 2
+                    for s0, s1 in zip(starts[:-1], starts[1:])] + [length]
+    return starts, bounds
+
+
+def extract_tiled(model, image: torch.Tensor, tile_size: int, overlap: int):
+    '''Extract local features from overlapping tiles of a 1xCxHxW image,
+    one tile at a time. Each keypoint is kept only by the tile whose core
+    contains it, which removes the duplicates of the overlaps and the
+    detections at the borders of the tiles. The keypoints with the highest
+    scores are then selected over the full image.'''
+    h, w = image.shape[-2:]
+    ys, bounds_y = tile_offsets(h, tile_size, overlap)
+    xs, bounds_x = tile_offsets(w, tile_size, overlap)
+    keypoints, scores, descriptors = [], [], []
+    for i, y in enumerate(ys):
+        for j, x in enumerate(xs):
+            tile = image[..., y:y+tile_size, x:x+tile_size]
+            pred = model({'image': tile})
+            if 'keypoints' not in pred:
+                raise ValueError('Tiling requires a local feature extractor.')
+            kpts = pred['keypoints'][0]
+            kpts = kpts + kpts.new_tensor([x, y])  # same pixel convention
+            valid = ((kpts[:, 0] >= bounds_x[j])
+                     & (kpts[:, 0] < bounds_x[j+1])
+                     & (kpts[:, 1] >= bounds_y[i])
+                     & (kpts[:, 1] < bounds_y[i+1]))
+            keypoints.append(kpts[valid])
+            scores.append(pred['scores'][0][valid])
+            descriptors.append(pred['descriptors'][0][:, valid])
+    keypoints = torch.cat(keypoints, 0)
+    scores = torch.cat(scores, 0)
+    descriptors = torch.cat(descriptors, 1)
+
+    max_keypoints = model.conf.get('max_keypoints', -1)
+    if 0 < max_keypoints < len(scores):
+        scores, indices = torch.topk(scores, max_keypoints)
+        keypoints, descriptors = keypoints[indices], descriptors[:, indices]
+    return {
+        'keypoints': keypoints,
+        'scores': scores,
+        'descriptors': descriptors,
+    }
+
+
+def batch_by_shape(loader, batch_size: int,
+                   max_buffered: Optional[int] = None):
+    '''Group the samples of an unbatched loader into batches of images with
+    identical shapes, such that they can be processed in a single forward.
+    Incomplete batches are flushed when too many images are buffered.
+    '''
+    if max_buffered is None:
+        max_buffered = 4 * batch_size
+    buckets = defaultdict(list)
+    num_buffered = 0
+    for data in loader:
+        shape = tuple(data['image'].shape)
+        buckets[shape].append(data)
+        num_buffered += 1
+        if len(buckets[shape]) < batch_size and num_buffered < max_buffered:
+            continue
+        if len(buckets[shape]) < batch_size:  # flush the largest bucket
+            shape = max(buckets, key=lambda k: len(buckets[k]))
+        bucket = buckets.pop(shape)
+        num_buffered -= len(bucket)
+        yield default_collate(bucket)
+    for bucket in buckets.values():
+        yield default_collate(bucket)
+
+
 @torch.no_grad()
+def run_extraction(model, loader, writer, device, as_half, num_images,
+                   quantize=None, cache=None, cache_keys=None, tiling=None,
+                   pca=None):
+    timings = defaultdict(float)
+    pbar = tqdm(total=num_images)
+    start = time.time()
+    for data in loader:
+        timings['decoding'] += time.time() - start  # waiting for the loader
+        start = time.time()
+        if tiling is None:
+            preds = model(map_tensor(data, lambda x: x.to(device)))
+            # remove the batch dimension, or pick from per-image lists
+            preds = [{k: v[i].cpu().numpy() for k, v in preds.items()}
+                     for i in range(len(data['name']))]
+        else:
+            preds = [extract_tiled(model, image[None].to(device), **tiling)
+                     for image in data['image']]
+            preds = [{k: v.cpu().numpy() for k, v in pred.items()}
+                     for pred in preds]
+        timings['inference'] += time.time() - start
+
+        start = time.time()
+        size = np.array(data['image'].shape[-2:][::-1])
+        for i, (name, pred) in enumerate(zip(data['name'], preds)):
+            if pca is not None:
+                pred['global_descriptor'] = compress_global_features.project(
+                    pred['global_descriptor'], *pca)
+            original_size = data['original_size'][i].numpy()
+            pred, attrs = postprocess_prediction(
+                pred, original_size, size,
+                getattr(model, 'detection_noise', 1), as_half, quantize)
+            writer.write(name, pred, attrs)
+            if cache is not None:
+                cache.put(cache_keys[name], pred, attrs)
+        timings['writing'] += time.time() - start  # waiting for the writer
+        pbar.update(len(data['name']))
+        del preds
+        start = time.time()
+    pbar.close()
+    return timings, pbar.n
+
+
+def extract_names(conf, dataset, feature_path, as_half, batch_size,
+                  quantize=None, cache_dir=None, cache_max_gb=50.,
+                  storage=None):
+    model_conf = conf['model']
+    root = dataset.source if isinstance(dataset, ImageStream) else (
+        dataset.root)
+    if model_conf.get('int8') is not None and root.is_dir():
+        # By default, calibrate the quantization on the images to extract.
+        model_conf = {**model_conf, 'int8': {
+            'calibration_dir': root,
+            'resize_max': conf['preprocessing'].get('resize_max'),
+            **model_conf['int8']}}
+
+    writer = FeatureWriter(feature_path, storage=storage)
+    try:
+        cache = cache_keys = None
+        if cache_dir is not None and isinstance(dataset, ImageDataset):
+            # Copy the features of images that were already extracted with
+            # the same configuration, possibly under other names or outputs.
+            pca_key = conf.get('pca')
+            if pca_key is not None:  # the PCA can be refit at the same path
+                pca_key = {'dim': pca_key['dim'],
+                           'sha1': hash_file(pca_key['path'])}
+            cache = ExtractionCache(cache_dir, {
+                'model': model_conf,
+                'preprocessing': conf['preprocessing'],
+                'tiling': conf.get('tiling'),
+                'pca': pca_key,
+                'as_half': as_half,
+                'quantize': quantize,
+                'version': __version__,
+            }, cache_max_gb)
+            keys = cache.keys([dataset.root / n for n in dataset.names])
+            cache_keys = dict(zip(dataset.names, keys))
+            misses = []
+            for name in dataset.names:
+                entry = cache.get(cache_keys[name])
+                if entry is None:
+                    misses.append(name)
+                else:
+                    writer.write(name, *entry)
+            logger.info('Found %d/%d images in the feature cache.',
+                        cache.hits, len(dataset.names))
+            dataset.names = misses
+            if len(dataset.names) == 0:
+                return
+
+        # CPU-optimized and quantized models run on CPU even with a GPU.
+        use_cuda = torch.cuda.is_available() and (
+            conf['model'].get('cpu') is None
+            and conf['model'].get('int8') is None)
+        device = 'cuda' if use_cuda else 'cpu'
+        model = get_model(extractors, model_conf, device)
+
+        # Worker processes hand the decoded images over in shared memory.
+        # Images are batched by shape after loading, as their size is unknown.
+        loader_conf = {**default_loader_conf, **conf.get('loader', {})}
+        if isinstance(dataset, ImageStream):
+            # frames are read sequentially, each worker would read them all
+            loader_conf['num_workers'] = min(loader_conf['num_workers'], 1)
+        kwargs = {}
+        if loader_conf['num_workers'] > 0:  # otherwise loading is synchronous
+            kwargs['prefetch_factor'] = loader_conf['prefetch_factor']
+        loader = torch.utils.data.DataLoader(
+            dataset, batch_size=None, num_workers=loader_conf['num_workers'],
+            pin_memory=(device == 'cuda'), worker_init_fn=worker_init_fn,
+            **kwargs)
+        loader = batch_by_shape(loader, batch_size)
+
+        num_images = (len(dataset) if isinstance(dataset, ImageDataset)
+                      else None)  # unknown before reading the stream
+        tiling = get_tiling_conf(conf)
+        pca = conf.get('pca')
+        if pca is not None:
+            pca = (compress_global_features.load(pca['path']), pca['dim'])
+        timings, num_images = run_extraction(
+            model, loader, writer, device, as_half, num_images, quantize,
+            cache, cache_keys, tiling, pca)
+    finally:
+        start = time.time()
+        writer.close()
+    timings['writing'] += time.time() - start
+
+    total = sum(timings.values())
+    logger.info(
+        'Finished exporting features at %.2f images/s, time spent: %s.',
+        num_images / total, ', '.join(
+            f'{k} {v:.1f}s ({100*v/total:.0f}%)' for k, v in timings.items()))
+    if timings['decoding'] > timings['inference']:
+        logger.info('The extraction is limited by the image decoding, '
+                    'consider increasing the number of loader workers.')
+
+
 def main(conf: Dict,
          image_dir: Path,
          export_dir: Optional[Path] = None,
          as_half: bool = True,
          image_list: Optional[Union[Path, List[str]]] = None,
          feature_path: Optional[Path] = None,
-         overwrite: bool = False) -> Path:
+         overwrite: bool = False,
+         batch_size: int = 1,
+         shard: Optional[Tuple[int, int]] = None,
+         cache_dir: Optional[Path] = None,
+         cache_max_gb: float = 50.,
+         quantize: Optional[str] = None,
+         storage: Optional[Union[str, Dict]] = None,
+         stream: Optional[Dict] = None) -> Path:
     logger.info('Extracting local features with configuration:'
                 f'\n{pprint.pformat(conf)}')
 
-    loader = ImageDataset(image_dir, conf['preprocessing'], image_list)
-    loader = torch.utils.data.DataLoader(loader, num_workers=1)
-
+    get_tiling_conf(conf)  # fail before reading any image
+    image_dir = Path(image_dir)
+    if stream is None and (
+            image_dir.suffix.lower() in ImageStream.video_extensions):
+        stream = {}
+    if stream is not None:
+        if shard is not None:
+            raise ValueError('Streams cannot be extracted in shards.')
+        dataset = ImageStream(image_dir, {**conf['preprocessing'], **stream})
+    else:
+        dataset = ImageDataset(image_dir, conf['preprocessing'], image_list)
     if feature_path is None:
         feature_path = Path(export_dir, conf['output']+'.h5')
     feature_path.parent.mkdir(exist_ok=True, parents=True)
+    if shard is not None:
+        # Write only the images of one shard of a sharded feature store,
+        # so that several processes or machines can extract concurrently.
+        index, num_shards = shard
+        dataset.names = [n for n in dataset.names
+                         if shard_of(n, num_shards) == index]
+        store_path, feature_path = (
+            feature_path, shard_path(feature_path, index, num_shards))
+        mark_shard(feature_path, complete=False)
     skip_names = set(list_h5_names(feature_path)
                      if feature_path.exists() and not overwrite else ())
-    if set(loader.dataset.names).issubset(set(skip_names)):
-        logger.info('Skipping the extraction.')
+    if stream is not None:
+        # Frames are selected while reading, extract the new ones only.
+        dataset.skip_names = skip_names
+        extract_names(conf, dataset, feature_path, as_half, batch_size,
+                      quantize, None, cache_max_gb, storage)
         return feature_path
+    dataset.names = [n for n in dataset.names if n not in skip_names]
+    if len(dataset.names) == 0:
+        logger.info('Skipping the extraction.')
+        if shard is not None:
+            # The manifest requires all the shards, even those without images.
+            FeatureWriter(feature_path, storage=storage).close()
+    else:
+        extract_names(conf, dataset, feature_path, as_half, batch_size,
+                      quantize, cache_dir, cache_max_gb, storage)
 
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    Model = dynamic_load(extractors, conf['model']['name'])
-    model = Model(conf['model']).eval().to(device)
-
-    for data in tqdm(loader):
-        name = data['name'][0]  # remove batch dimension
-        if name in skip_names:
-            continue
-
-        pred = model(map_tensor(data, lambda x: x.to(device)))
-        pred = {k: v[0].cpu().numpy() for k, v in pred.items()}
-
-        pred['image_size'] = original_size = data['original_size'][0].numpy()
-        if 'keypoints' in pred:
-            size = np.array(data['image'].shape[-2:][::-1])
-            scales = (original_size / size).astype(np.float32)
-            pred['keypoints'] = (pred['keypoints'] + .5) * scales[None] - .5
-            # add keypoint uncertainties scaled to the original resolution
-            uncertainty = getattr(model, 'detection_noise', 1) * scales.mean()
-
-        if as_half:
-            for k in pred:
-                dt = pred[k].dtype
-                if (dt == np.float32) and (dt != np.float16):
-                    pred[k] = pred[k].astype(np.float16)
-
-        with h5py.File(str(feature_path), 'a') as fd:
-            try:
-                if name in fd:
-                    del fd[name]
-                grp = fd.create_group(name)
-                for k, v in pred.items():
-                    grp.create_dataset(k, data=v)
-                if 'keypoints' in pred:
-                    grp['keypoints'].attrs['uncertainty'] = uncertainty
-            except OSError as error:
-                if 'No space left on device' in error.args[0]:
-                    logger.error(
-                        'Out of disk space: storing features on disk can take '
-                        'significant space, did you enable the as_half flag?')
-                    del grp, fd[name]
-                raise error
-
-        del pred
-
-    logger.info('Finished exporting features.')
+    if shard is not None:
+        mark_shard(feature_path)
+        # The last shard to finish writes the manifest of the store.
+        if write_manifest(store_path, num_shards):
+            logger.info('Wrote the manifest of the sharded feature store.')
+        else:
+            logger.info('Other shards are still being extracted.')
+        return manifest_path(store_path)
     return feature_path
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--image_dir', type=Path, required=True)
+    parser.add_argument('--image_dir', type=Path, required=True,
+                        help='Directory of images, or video file')
     parser.add_argument('--export_dir', type=Path, required=True)
     parser.add_argument('--conf', type=str, default='superpoint_aachen',
                         choices=list(confs.keys()))
     parser.add_argument('--as_half', action='store_true')
+    parser.add_argument('--quantize', type=str, choices=['int8'],
+                        help='Store the local descriptors as int8')
+    parser.add_argument('--storage', type=str,
+                        choices=list(storage_profiles.keys()),
+                        help='Chunking and compression of the datasets')
     parser.add_argument('--image_list', type=Path)
     parser.add_argument('--feature_path', type=Path)
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--shard', type=int, nargs=2,
+                        metavar=('INDEX', 'NUM_SHARDS'))
+    parser.add_argument('--cache_dir', type=Path)
+    parser.add_argument('--cache_max_gb', type=float, default=50.)
+    parser.add_argument('--num_workers', type=int,
+                        default=default_loader_conf['num_workers'])
+    parser.add_argument('--prefetch_factor', type=int,
+                        default=default_loader_conf['prefetch_factor'])
+    parser.add_argument('--tile_size', type=int,
+                        help='Extract local features from tiles of this size')
+    parser.add_argument('--tile_overlap', type=int,
+                        default=default_tiling_conf['overlap'])
+    parser.add_argument('--pca', type=Path,
+                        help='Compress the global descriptors with this PCA')
+    parser.add_argument('--pca_dim', type=int, default=256)
+    parser.add_argument('--stream', action='store_true',
+                        help='Read the images in the order of their timestamp')
+    parser.add_argument('--stride', type=int, default=1)
+    parser.add_argument('--min_time_gap', type=float,
+                        help='Minimum time between two frames, in seconds')
+    parser.add_argument('--min_motion', type=float,
+                        help='Minimum mean intensity change between frames')
     args = parser.parse_args()
-    main(confs[args.conf], args.image_dir, args.export_dir, args.as_half)
+    conf = {**confs[args.conf], 'loader': {
+        'num_workers': args.num_workers,
+        'prefetch_factor': args.prefetch_factor}}
+    if args.pca is not None:
+        conf['pca'] = {'path': args.pca, 'dim': args.pca_dim}
+    if args.tile_size is not None:
+        conf['tiling'] = {'tile_size': args.tile_size,
+                          'overlap': args.tile_overlap}
+    stream = None
+    if args.stream or args.stride > 1 or args.min_time_gap or args.min_motion:
+        stream = {'stride': args.stride, 'min_time_gap': args.min_time_gap,
+                  'min_motion': args.min_motion}
+    main(conf, args.image_dir, args.export_dir, args.as_half,
+         args.image_list, args.feature_path, batch_size=args.batch_size,
+         shard=args.shard, cache_dir=args.cache_dir,
+         cache_max_gb=args.cache_max_gb, quantize=args.quantize,
+         storage=args.storage, stream=stream)
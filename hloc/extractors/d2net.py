@@ -39,16 +39,16 @@ class D2Net(BaseModel):
         norm = image.new_tensor([103.939, 116.779, 123.68])
         image = (image * 255 - norm.view(1, 3, 1, 1))  # caffe normalization
 
-        if self.conf['multiscale']:
-            keypoints, scores, descriptors = process_multiscale(
-                image, self.net)
-        else:
-            keypoints, scores, descriptors = process_multiscale(
-                image, self.net, scales=[1])
-        keypoints = keypoints[:, [1, 0]]  # (x, y) and remove the scale
-
-        return {
-            'keypoints': torch.from_numpy(keypoints)[None],
-            'scores': torch.from_numpy(scores)[None],
-            'descriptors': torch.from_numpy(descriptors.T)[None],
-        }
+        pred = {'keypoints': [], 'scores': [], 'descriptors': []}
+        for image_i in image:  # D2-Net processes a single image at a time
+            if self.conf['multiscale']:
+                keypoints, scores, descriptors = process_multiscale(
+                    image_i[None], self.net)
+            else:
+                keypoints, scores, descriptors = process_multiscale(
+                    image_i[None], self.net, scales=[1])
+            keypoints = keypoints[:, [1, 0]]  # (x, y) and remove the scale
+            pred['keypoints'].append(torch.from_numpy(keypoints))
+            pred['scores'].append(torch.from_numpy(scores))
+            pred['descriptors'].append(torch.from_numpy(descriptors.T))
+        return pred
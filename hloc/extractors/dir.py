@@ -3,8 +3,6 @@ from pathlib import Path
 import torch
 from zipfile import ZipFile
 import os
-import sklearn
-import gdown
 
 from ..utils.base_model import BaseModel
 
@@ -15,12 +13,6 @@ os.environ['DB_ROOT'] = ''  # required by dirtorch
 from dirtorch.utils import common  # noqa: E402
 from dirtorch.extract_features import load_model  # noqa: E402
 
-# The DIR model checkpoints (pickle files) include sklearn.decomposition.pca,
-# which has been deprecated in sklearn v0.24
-# and must be explicitly imported with `from sklearn.decomposition import PCA`.
-# This is a hacky workaround to maintain forward compatibility.
-sys.modules['sklearn.decomposition.pca'] = sklearn.decomposition._pca
-
 
 class DIR(BaseModel):
     default_conf = {
@@ -45,6 +37,7 @@ class DIR(BaseModel):
         checkpoint = conf['checkpoint_dir'] / str(conf['model_name']+'.pt')
         if not checkpoint.exists():
             checkpoint.parent.mkdir(exist_ok=True)
+            import gdown
             link = self.dir_models[conf['model_name']]
             gdown.download(str(link), str(checkpoint)+'.zip', quiet=False)
             zf = ZipFile(str(checkpoint)+'.zip', 'r')
@@ -52,6 +45,14 @@ class DIR(BaseModel):
             zf.close()
             os.remove(str(checkpoint)+'.zip')
 
+        # The DIR model checkpoints (pickle files) include
+        # sklearn.decomposition.pca, which has been deprecated in sklearn
+        # v0.24 and must be explicitly imported with
+        # `from sklearn.decomposition import PCA`. This is a hacky workaround
+        # to maintain forward compatibility.
+        import sklearn.decomposition
+        sys.modules['sklearn.decomposition.pca'] = sklearn.decomposition._pca
+
         self.net = load_model(checkpoint, False)  # first load on CPU
         if conf['whiten_name']:
             assert conf['whiten_name'] in self.net.pca
@@ -65,7 +66,7 @@ class DIR(BaseModel):
         image = image / image.new_tensor(std)[:, None, None]
 
         desc = self.net(image)
-        desc = desc.unsqueeze(0)  # batch dimension
+        desc = desc.view(image.shape[0], -1)  # the batch dimension is squeezed
         if self.conf['whiten_name']:
             pca = self.net.pca[self.conf['whiten_name']]
             desc = common.whiten_features(
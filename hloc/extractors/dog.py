@@ -1,8 +1,5 @@
-import kornia
-from kornia.feature.laf import (
-    laf_from_center_scale_ori, raise_error_if_laf_is_not_valid,
-    normalize_laf, denormalize_laf, get_laf_scale,
-    generate_patch_grid_from_normalized_LAF, pyrdown)
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import numpy as np
 import torch
 import torch.nn.functional as F
@@ -16,12 +13,18 @@ EPS = 1e-6
 
 def extract_patches_from_pyramid(
     img: torch.Tensor, laf: torch.Tensor, PS: int = 32,
-    normalize_lafs_before_extraction: bool = True
+    normalize_lafs_before_extraction: bool = True,
+    chunk_size: int = 1024,
 ) -> torch.Tensor:
     """Extract patches defined by LAFs from image tensor.
-    Copied from kornia.feature.laf.extract_patches_from_pyramid with one minor
-    difference - highlighted below.
+    Adapted from kornia.feature.laf.extract_patches_from_pyramid with one minor
+    difference - highlighted below. The patches of each pyramid level are
+    sampled from a single copy of the image, by chunks of chunk_size patches
+    to bound the memory.
     """
+    from kornia.feature.laf import (
+        raise_error_if_laf_is_not_valid, normalize_laf, denormalize_laf,
+        get_laf_scale, generate_patch_grid_from_normalized_LAF, pyrdown)
     raise_error_if_laf_is_not_valid(laf)
     if normalize_lafs_before_extraction:
         nlaf: torch.Tensor = normalize_laf(laf, img)
@@ -31,26 +34,28 @@ def extract_patches_from_pyramid(
     _, ch, h, w = img.size()
     scale = 2.0 * get_laf_scale(denormalize_laf(nlaf, img)) / float(PS)
     pyr_idx = scale.log2().relu().long()  # diff: floor instead of round
+    pyr_idx = pyr_idx.view(B, N)
     cur_img = img
     cur_pyr_level = 0
     out = torch.zeros(B, N, ch, PS, PS).to(nlaf.dtype).to(nlaf.device)
     while min(cur_img.size(2), cur_img.size(3)) >= PS:
         _, ch, h, w = cur_img.size()
-        # for loop temporarily, to be refactored
         for i in range(B):
-            scale_mask = (pyr_idx[i] == cur_pyr_level).squeeze()
-            if (scale_mask.float().sum()) == 0:
+            indices = torch.where(pyr_idx[i] == cur_pyr_level)[0]
+            if len(indices) == 0:
                 continue
-            scale_mask = (scale_mask > 0).view(-1)
-            grid = generate_patch_grid_from_normalized_LAF(
-                    cur_img[i: i + 1], nlaf[i: i + 1, scale_mask, :, :], PS)
-            patches = F.grid_sample(
-                cur_img[i: i + 1].expand(grid.size(0), ch, h, w),
-                grid,  # type: ignore
-                padding_mode="border",
-                align_corners=False,
-            )
-            out[i].masked_scatter_(scale_mask.view(-1, 1, 1, 1), patches)
+            for chunk in torch.split(indices, chunk_size):
+                grid = generate_patch_grid_from_normalized_LAF(
+                        cur_img[i: i + 1], nlaf[i: i + 1, chunk], PS)
+                # Sample the patches as the rows of a single tall image.
+                n = len(chunk)
+                patches = F.grid_sample(
+                    cur_img[i: i + 1],
+                    grid.reshape(1, n * PS, PS, 2),
+                    padding_mode="border",
+                    align_corners=False,
+                )
+                out[i, chunk] = patches.view(ch, n, PS, PS).transpose(0, 1)
         cur_img = pyrdown(cur_img)
         cur_pyr_level += 1
     return out
@@ -63,6 +68,31 @@ def sift_to_rootsift(x):
     return x
 
 
+def create_sift(options, descriptor, use_gpu=False):
+    options = {**options}
+    if descriptor == 'rootsift':
+        options['normalization'] = pycolmap.Normalization.L1_ROOT
+    else:
+        options['normalization'] = pycolmap.Normalization.L2
+    return pycolmap.Sift(
+        options=pycolmap.SiftExtractionOptions(options),
+        device=getattr(pycolmap.Device, 'cuda' if use_gpu else 'cpu'))
+
+
+# The SIFT extractor of each worker process.
+_worker_sift = None
+
+
+def init_sift_worker(options, descriptor):
+    global _worker_sift
+    torch.set_num_threads(1)
+    _worker_sift = create_sift(options, descriptor)
+
+
+def run_sift_worker(image):
+    return _worker_sift.extract(image)
+
+
 class DoG(BaseModel):
     default_conf = {
         'options': {
@@ -73,17 +103,25 @@ class DoG(BaseModel):
         'max_keypoints': -1,
         'patch_size': 32,
         'mr_size': 12,
+        # Extract the images of a batch in parallel in this number of worker
+        # processes, each with its own SIFT extractor. pycolmap holds the
+        # GIL during the extraction, so threads would not run in parallel.
+        # Requires a batch size of extract_features >= num_workers.
+        'num_workers': 0,
     }
     required_inputs = ['image']
     detection_noise = 1.0
 
     def _init(self, conf):
         if conf['descriptor'] == 'sosnet':
+            # kornia is only required by the learned descriptors
+            import kornia
             self.describe = kornia.feature.SOSNet(pretrained=True)
         elif conf['descriptor'] not in ['sift', 'rootsift']:
             raise ValueError(f'Unknown descriptor: {conf["descriptor"]}')
 
         self.sift = None  # lazily instantiated on the first image
+        self.pool = None
         self.device = torch.device('cpu')
 
     def to(self, *args, **kwargs):
@@ -96,25 +134,43 @@ class DoG(BaseModel):
             self.device = torch.device(device)
         return super().to(*args, **kwargs)
 
+    def release(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
     def _forward(self, data):
         image = data['image']
-        image_np = image.cpu().numpy()[0, 0]
         assert image.shape[1] == 1
-        assert image_np.min() >= -EPS and image_np.max() <= 1 + EPS
-
-        if self.sift is None:
-            use_gpu = pycolmap.has_cuda and self.device.type == 'cuda'
-            options = {**self.conf['options']}
-            if self.conf['descriptor'] == 'rootsift':
-                options['normalization'] = pycolmap.Normalization.L1_ROOT
-            else:
-                options['normalization'] = pycolmap.Normalization.L2
-            self.sift = pycolmap.Sift(
-                options=pycolmap.SiftExtractionOptions(options),
-                device=getattr(pycolmap.Device, 'cuda' if use_gpu else 'cpu'))
-
-        keypoints, scores, descriptors = self.sift.extract(image_np)
-
+        images_np = image.cpu().numpy()[:, 0]
+        assert images_np.min() >= -EPS and images_np.max() <= 1 + EPS
+        use_gpu = pycolmap.has_cuda and self.device.type == 'cuda'
+        if self.conf['num_workers'] > 0 and not use_gpu and len(image) > 1:
+            if self.pool is None:
+                # Workers are spawned since forking a process that uses
+                # torch or loader threads is unsafe.
+                self.pool = ProcessPoolExecutor(
+                    self.conf['num_workers'],
+                    multiprocessing.get_context('spawn'),
+                    initializer=init_sift_worker,
+                    initargs=(self.conf['options'], self.conf['descriptor']))
+            detections = self.pool.map(run_sift_worker, images_np)  # ordered
+        else:
+            if self.sift is None:
+                self.sift = create_sift(
+                    self.conf['options'], self.conf['descriptor'], use_gpu)
+            detections = map(self.sift.extract, images_np)
+
+        pred = {'keypoints': [], 'scores': [], 'descriptors': []}
+        for image_i, detection in zip(image, detections):
+            keypoints, scores, descriptors = self._describe(
+                image_i[None], *detection)
+            pred['keypoints'].append(keypoints)
+            pred['scores'].append(scores)
+            pred['descriptors'].append(descriptors)
+        return pred
+
+    def _describe(self, image, keypoints, scores, descriptors):
         if self.conf['descriptor'] in ['sift', 'rootsift']:
             # We still renormalize because COLMAP does not normalize well,
             # maybe due to numerical errors
@@ -122,6 +178,7 @@ class DoG(BaseModel):
                 descriptors = sift_to_rootsift(descriptors)
             descriptors = torch.from_numpy(descriptors)
         elif self.conf['descriptor'] == 'sosnet':
+            from kornia.feature.laf import laf_from_center_scale_ori
             center = keypoints[:, :2] + 0.5
             scale = keypoints[:, 2] * self.conf['mr_size'] / 2
             ori = -np.rad2deg(keypoints[:, 3])
@@ -144,13 +201,9 @@ class DoG(BaseModel):
         if self.conf['max_keypoints'] != -1:
             # TODO: check that the scores from PyCOLMAP are 100% correct,
             # follow https://github.com/mihaidusmanu/pycolmap/issues/8
-            indices = torch.topk(scores, self.conf['max_keypoints'])
+            indices = torch.topk(scores, self.conf['max_keypoints']).indices
             keypoints = keypoints[indices]
             scores = scores[indices]
             descriptors = descriptors[indices]
 
-        return {
-            'keypoints': keypoints[None],
-            'scores': scores[None],
-            'descriptors': descriptors.T[None],
-        }
+        return keypoints, scores, descriptors.T
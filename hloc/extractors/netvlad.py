@@ -1,6 +1,10 @@
 from pathlib import Path
+import argparse
+import itertools
 import subprocess
 import logging
+import os
+import time
 import numpy as np
 import torch
 import torch.nn as nn
@@ -9,6 +13,7 @@ import torchvision.models as models
 from scipy.io import loadmat
 
 from ..utils.base_model import BaseModel
+from ..utils.inference import CPUInference, quantize_int8
 
 logger = logging.getLogger(__name__)
 
@@ -18,7 +23,8 @@ EPS = 1e-6
 
 
 class NetVLADLayer(nn.Module):
-    def __init__(self, input_dim=512, K=64, score_bias=False, intranorm=True):
+    def __init__(self, input_dim=512, K=64, score_bias=False, intranorm=True,
+                 memory_efficient=True):
         super().__init__()
         self.score_proj = nn.Conv1d(
             input_dim, K, kernel_size=1, bias=score_bias)
@@ -26,14 +32,21 @@ class NetVLADLayer(nn.Module):
         nn.init.xavier_uniform_(centers)
         self.register_parameter('centers', centers)
         self.intranorm = intranorm
+        self.memory_efficient = memory_efficient
         self.output_dim = input_dim * K
 
     def forward(self, x):
         b = x.size(0)
         scores = self.score_proj(x)
         scores = F.softmax(scores, dim=1)
-        diff = (x.unsqueeze(2) - self.centers.unsqueeze(0).unsqueeze(-1))
-        desc = (scores.unsqueeze(1) * diff).sum(dim=-1)
+        if self.memory_efficient:
+            # sum_n a_kn (x_n - c_k) = sum_n a_kn x_n - c_k sum_n a_kn
+            # without the B x D x K x N tensor of residuals
+            desc = torch.einsum('bkn,bdn->bdk', scores, x)
+            desc = desc - self.centers[None] * scores.sum(-1)[:, None]
+        else:
+            diff = (x.unsqueeze(2) - self.centers.unsqueeze(0).unsqueeze(-1))
+            desc = (scores.unsqueeze(1) * diff).sum(dim=-1)
         if self.intranorm:
             # From the official MATLAB implementation.
             desc = F.normalize(desc, dim=1)
@@ -42,11 +55,56 @@ class NetVLADLayer(nn.Module):
         return desc
 
 
+def peak_memory(layer: nn.Module, x: torch.Tensor) -> int:
+    '''Peak memory, in bytes, allocated by the forward pass of a layer.
+    On CPU, it is tracked by the profiler at the granularity of the ops.'''
+    with torch.no_grad():
+        if x.is_cuda:
+            torch.cuda.synchronize(x.device)
+            torch.cuda.reset_peak_memory_stats(x.device)
+            start = torch.cuda.memory_allocated(x.device)
+            layer(x)
+            return torch.cuda.max_memory_allocated(x.device) - start
+        with torch.profiler.profile(profile_memory=True) as prof:
+            layer(x)
+    events = sorted(prof.events(), key=lambda e: e.time_range.start)
+    usage = itertools.accumulate(e.self_cpu_memory_usage for e in events)
+    return max(0, max(usage, default=0))
+
+
+def check_memory_efficient(num_images: int = 2, num_features: int = 3000,
+                           device: str = 'cpu'):
+    '''Compare the memory-efficient aggregation of NetVLADLayer with the
+    explicit residuals on random features: outputs, peak memory, time.'''
+    torch.manual_seed(0)
+    layer = NetVLADLayer(memory_efficient=False).eval().to(device)
+    x = F.normalize(torch.randn(
+        num_images, layer.score_proj.in_channels, num_features,
+        device=device), dim=1)
+    outputs = {}
+    for memory_efficient in [False, True]:
+        layer.memory_efficient = memory_efficient
+        peak = peak_memory(layer, x)
+        with torch.no_grad():
+            start = time.time()
+            outputs[memory_efficient] = layer(x)
+            if x.is_cuda:
+                torch.cuda.synchronize(x.device)
+            duration = time.time() - start
+        logger.info('memory_efficient=%-5s: peak %8.1f MB, %7.1f ms',
+                    memory_efficient, peak / 1e6, duration * 1e3)
+    diff = (outputs[True] - outputs[False]).abs().max().item()
+    logger.info('Max absolute difference of the descriptors: %.2e.', diff)
+    return diff
+
+
 class NetVLAD(BaseModel):
     default_conf = {
         'model_name': 'VGG16-NetVLAD-Pitts30K',
         'checkpoint_dir': netvlad_path,
-        'whiten': True
+        'whiten': True,
+        'cpu': None,  # CPU inference mode of the backbone
+        'int8': None,  # int8 quantization of the backbone
     }
     required_inputs = ['image']
 
@@ -60,6 +118,52 @@ class NetVLAD(BaseModel):
     def _init(self, conf):
         assert conf['model_name'] in self.dir_models.keys()
 
+        # Create the network.
+        # Only the convolutional layers, without the classification head.
+        backbone = models.vgg.make_layers(models.vgg.cfgs['D'])
+        # Remove last ReLU + MaxPool2d.
+        self.backbone = nn.Sequential(*list(backbone.children())[: -2])
+
+        self.netvlad = NetVLADLayer()
+
+        if conf['whiten']:
+            # The weights are loaded below, skip the slow initialization.
+            if hasattr(nn.utils, 'skip_init'):  # PyTorch>=1.10
+                self.whiten = nn.utils.skip_init(
+                    nn.Linear, self.netvlad.output_dim, 4096)
+            else:
+                self.whiten = nn.Linear(self.netvlad.output_dim, 4096)
+
+        # Parsing the MATLAB checkpoint is slow, so we convert it only once.
+        suffix = '' if conf['whiten'] else '-nowhiten'
+        state_path = conf['checkpoint_dir'] / str(
+            conf['model_name'] + suffix + '.pth')
+        if state_path.exists():
+            state = torch.load(str(state_path), map_location='cpu')
+            mean = state.pop('mean').numpy()
+            self.load_state_dict(state)
+        else:
+            mean = self.load_mat_checkpoint(conf)
+            state = {**self.state_dict(), 'mean': torch.from_numpy(mean)}
+            tmp_path = state_path.with_suffix(f'.{os.getpid()}.tmp')
+            torch.save(state, str(tmp_path))
+            os.replace(str(tmp_path), str(state_path))
+            logger.info(f'Converted the NetVLAD checkpoint to {state_path}.')
+
+        # Preprocessing parameters.
+        self.preprocess = {
+            'mean': mean,
+            'std': np.array([1, 1, 1], dtype=np.float32)
+        }
+
+        if conf['int8'] is not None:
+            self.backbone = CPUInference(quantize_int8(
+                self.backbone, conf['int8'], f'netvlad-{conf["model_name"]}',
+                grayscale=False, preprocess=self.normalize), conf['cpu'])
+        elif conf['cpu'] is not None:
+            self.backbone = CPUInference(self.backbone, conf['cpu'])
+
+    def load_mat_checkpoint(self, conf):
         # Download the checkpoint.
         checkpoint = conf['checkpoint_dir'] / str(conf['model_name'] + '.mat')
         if not checkpoint.exists():
@@ -69,17 +173,6 @@ class NetVLAD(BaseModel):
             logger.info(f'Downloading the NetVLAD model with `{cmd}`.')
             subprocess.run(cmd, check=True)
 
-        # Create the network.
-        # Remove classification head.
-        backbone = list(models.vgg16().children())[0]
-        # Remove last ReLU + MaxPool2d.
-        self.backbone = nn.Sequential(*list(backbone.children())[: -2])
-
-        self.netvlad = NetVLADLayer()
-
-        if conf['whiten']:
-            self.whiten = nn.Linear(self.netvlad.output_dim, 4096)
-
         # Parse MATLAB weights using https://github.com/uzh-rpg/netvlad_tf_open
         mat = loadmat(checkpoint, struct_as_record=False, squeeze_me=True)
 
@@ -123,20 +216,22 @@ class NetVLAD(BaseModel):
             self.whiten.bias = nn.Parameter(b)
 
         # Preprocessing parameters.
-        self.preprocess = {
-            'mean': mat['net'].meta.normalization.averageImage[0, 0],
-            'std': np.array([1, 1, 1], dtype=np.float32)
-        }
+        return np.asarray(
+            mat['net'].meta.normalization.averageImage[0, 0], np.float32)
 
-    def _forward(self, data):
-        image = data['image']
-        assert image.shape[1] == 3
-        assert image.min() >= -EPS and image.max() <= 1 + EPS
+    def normalize(self, image):
         image = torch.clamp(image * 255, 0.0, 255.0)  # Input should be 0-255.
         mean = self.preprocess['mean']
         std = self.preprocess['std']
         image = image - image.new_tensor(mean).view(1, -1, 1, 1)
         image = image / image.new_tensor(std).view(1, -1, 1, 1)
+        return image
+
+    def _forward(self, data):
+        image = data['image']
+        assert image.shape[1] == 3
+        assert image.min() >= -EPS and image.max() <= 1 + EPS
+        image = self.normalize(image)
 
         # Feature extraction.
         descriptors = self.backbone(image)
@@ -155,3 +250,21 @@ class NetVLAD(BaseModel):
         return {
             'global_descriptor': desc
         }
+
+
+if __name__ == '__main__':
+    from .. import logger  # noqa: F811, with the handler of hloc
+    parser = argparse.ArgumentParser(
+        description='Check that the memory-efficient NetVLAD aggregation '
+        'is equivalent to the explicit one and report their peak memory.')
+    parser.add_argument('--num_images', type=int, default=2)
+    parser.add_argument('--num_features', type=int, default=3000,
+                        help='Number of local features per image, e.g. '
+                        '3000 for a 1024x768 image')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--tolerance', type=float, default=1e-5)
+    args = parser.parse_args()
+    diff = check_memory_efficient(
+        args.num_images, args.num_features, args.device)
+    if diff > args.tolerance:
+        raise ValueError(f'The aggregations differ by {diff:.2e}.')
@@ -37,20 +37,18 @@ class R2D2(BaseModel):
         img = data['image']
         img = self.norm_rgb(img)
 
-        xys, desc, scores = extract_multiscale(
-            self.net, img, self.detector,
-            scale_f=self.conf['scale_factor'],
-            min_size=self.conf['min_size'],
-            max_size=self.conf['max_size'],
-            min_scale=self.conf['min_scale'],
-            max_scale=self.conf['max_scale'],
-        )
-        idxs = scores.argsort()[-self.conf['max_keypoints'] or None:]
-        xy = xys[idxs, :2]
-        desc = desc[idxs].t()
-        scores = scores[idxs]
-
-        pred = {'keypoints': xy[None],
-                'descriptors': desc[None],
-                'scores': scores[None]}
+        pred = {'keypoints': [], 'descriptors': [], 'scores': []}
+        for img_i in img:  # the multiscale extraction expects a single image
+            xys, desc, scores = extract_multiscale(
+                self.net, img_i[None], self.detector,
+                scale_f=self.conf['scale_factor'],
+                min_size=self.conf['min_size'],
+                max_size=self.conf['max_size'],
+                min_scale=self.conf['min_scale'],
+                max_scale=self.conf['max_scale'],
+            )
+            idxs = scores.argsort()[-self.conf['max_keypoints'] or None:]
+            pred['keypoints'].append(xys[idxs, :2])
+            pred['descriptors'].append(desc[idxs].t())
+            pred['scores'].append(scores[idxs])
         return pred
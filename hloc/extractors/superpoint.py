@@ -1,8 +1,10 @@
 import sys
 from pathlib import Path
 import torch
+from torch import nn
 
 from ..utils.base_model import BaseModel
+from ..utils.inference import CPUInference, quantize_int8
 
 sys.path.append(str(Path(__file__).parent / '../../third_party'))
 from SuperGluePretrainedNetwork.models import superpoint  # noqa E402
@@ -44,6 +46,35 @@ def sample_descriptors_fix_sampling(keypoints, descriptors, s: int = 8):
     return descriptors
 
 
+class SuperPointDense(nn.Module):
+    '''The dense part of SuperPoint, which shares the weights of the
+    original network: the encoder and the raw outputs of both heads.
+    It has a fixed graph and can be compiled, unlike the sparse outputs.
+    '''
+    layers = ['conv1a', 'conv1b', 'conv2a', 'conv2b', 'conv3a', 'conv3b',
+              'conv4a', 'conv4b', 'convPa', 'convPb', 'convDa', 'convDb']
+
+    def __init__(self, net):
+        super().__init__()
+        for name in self.layers:
+            setattr(self, name, getattr(net, name))
+        self.relu = nn.ReLU(inplace=True)
+        self.pool = nn.MaxPool2d(kernel_size=2, stride=2)
+
+    def forward(self, image):
+        x = self.relu(self.conv1a(image))
+        x = self.pool(self.relu(self.conv1b(x)))
+        x = self.relu(self.conv2a(x))
+        x = self.pool(self.relu(self.conv2b(x)))
+        x = self.relu(self.conv3a(x))
+        x = self.pool(self.relu(self.conv3b(x)))
+        x = self.relu(self.conv4a(x))
+        x = self.relu(self.conv4b(x))
+        scores = self.convPb(self.relu(self.convPa(x)))
+        descriptors = self.convDb(self.relu(self.convDa(x)))
+        return scores, descriptors
+
+
 class SuperPoint(BaseModel):
     default_conf = {
         'nms_radius': 4,
@@ -51,6 +82,8 @@ class SuperPoint(BaseModel):
         'max_keypoints': -1,
         'remove_borders': 4,
         'fix_sampling': False,
+        'cpu': None,  # CPU inference mode, see utils.inference
+        'int8': None,  # int8 quantization of the dense network
     }
     required_inputs = ['image']
     detection_noise = 2.0
@@ -59,6 +92,50 @@ class SuperPoint(BaseModel):
         if conf['fix_sampling']:
             superpoint.sample_descriptors = sample_descriptors_fix_sampling
         self.net = superpoint.SuperPoint(conf)
+        self.dense = None
+        if conf['int8'] is not None:
+            # The last layers of the heads remain in float32 to preserve
+            # the accuracy of the detection and of the descriptors.
+            dense = quantize_int8(
+                SuperPointDense(self.net), conf['int8'], 'superpoint',
+                grayscale=True, float_layers=['convPb', 'convDb'])
+            self.dense = CPUInference(dense, conf['cpu'])
+        elif conf['cpu'] is not None:
+            self.dense = CPUInference(SuperPointDense(self.net), conf['cpu'])
 
     def _forward(self, data):
-        return self.net(data)
+        if self.dense is None:
+            return self.net(data)
+        scores, descriptors = self.dense(data['image'])
+        return self.postprocess(scores, descriptors)
+
+    def postprocess(self, scores, descriptors):
+        '''Same as the original network, from the raw dense outputs.'''
+        conf = self.net.config
+        scores = torch.nn.functional.softmax(scores, 1)[:, :-1]
+        b, _, h, w = scores.shape
+        scores = scores.permute(0, 2, 3, 1).reshape(b, h, w, 8, 8)
+        scores = scores.permute(0, 1, 3, 2, 4).reshape(b, h*8, w*8)
+        scores = superpoint.simple_nms(scores, conf['nms_radius'])
+
+        keypoints = [torch.nonzero(s > conf['keypoint_threshold'])
+                     for s in scores]
+        scores = [s[tuple(k.t())] for s, k in zip(scores, keypoints)]
+        keypoints, scores = list(zip(*[
+            superpoint.remove_borders(
+                k, s, conf['remove_borders'], h*8, w*8)
+            for k, s in zip(keypoints, scores)]))
+        if conf['max_keypoints'] >= 0:
+            keypoints, scores = list(zip(*[
+                superpoint.top_k_keypoints(k, s, conf['max_keypoints'])
+                for k, s in zip(keypoints, scores)]))
+        keypoints = [torch.flip(k, [1]).float() for k in keypoints]
+
+        descriptors = torch.nn.functional.normalize(descriptors, p=2, dim=1)
+        descriptors = [superpoint.sample_descriptors(k[None], d[None], 8)[0]
+                       for k, d in zip(keypoints, descriptors)]
+        return {
+            'keypoints': keypoints,
+            'scores': scores,
+            'descriptors': descriptors,
+        }
@@ -1,16 +1,21 @@
 import argparse
-from typing import Union, Optional, Dict, List, Tuple
+from typing import Union, Optional, Dict, List, Tuple, Iterable, Iterator
 from pathlib import Path
 import pprint
+import contextlib
+import itertools
 import collections.abc as collections
 from tqdm import tqdm
 import h5py
 import torch
 
 from . import matchers, logger
-from .utils.base_model import dynamic_load
+from .utils.base_model import get_model
 from .utils.parsers import names_to_pair, names_to_pair_old, parse_retrieval
-from .utils.io import list_h5_names
+from .utils.pairs import schedule_pairs
+from .utils.io import (
+    list_h5_names, FeatureWriter, FeatureReader, expand_h5_paths,
+    resolve_h5_path, storage_profiles, prefetch, limit_heap_fragmentation)
 
 
 '''
@@ -67,7 +72,13 @@ def main(conf: Dict,
          export_dir: Optional[Path] = None,
          matches: Optional[Path] = None,
          features_ref: Optional[Path] = None,
-         overwrite: bool = False) -> Path:
+         overwrite: bool = False,
+         storage: Optional[Union[str, Dict]] = None,
+         feature_cache_gb: float = 1.,
+         num_workers: int = 0,
+         queue_size: int = 16,
+         batch_size: int = 1,
+         one_to_many: bool = False) -> Path:
 
     if isinstance(features, Path) or Path(features).exists():
         features_q = features
@@ -90,7 +101,9 @@ def main(conf: Dict,
     else:
         features_ref = [features_ref]
 
-    match_from_paths(conf, pairs, matches, features_q, features_ref, overwrite)
+    match_from_paths(conf, pairs, matches, features_q, features_ref,
+                     overwrite, storage, feature_cache_gb, num_workers,
+                     queue_size, batch_size, one_to_many)
 
     return matches
 
@@ -116,13 +129,130 @@ def find_unique_new_pairs(pairs_all: List[Tuple[str]], match_path: Path = None):
     return pairs
 
 
+# Dimension of the keypoints in the batched local features.
+keypoint_dims = {'keypoints': 1, 'scores': 1, 'descriptors': 2}
+
+
+def num_keypoints(data: Dict, i: int) -> int:
+    return data[f'descriptors{i}'].shape[-1]
+
+
+def group_pairs(items: Iterable[Tuple[str, str, Dict]], batch_size: int,
+                padding: bool, window: int = 8) -> Iterator[List[Tuple]]:
+    '''Group consecutive pairs into batches of inputs with similar numbers
+    of keypoints, or with identical shapes if the model does not support
+    padding. Pairs are only regrouped within windows of window batches.'''
+    if batch_size == 1:
+        yield from ([item] for item in items)
+        return
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, window * batch_size))
+        if len(chunk) == 0:
+            break
+        if padding:
+            chunk.sort(key=lambda x: (
+                num_keypoints(x[2], 0), num_keypoints(x[2], 1)))
+            # pairs with fewer than 2 keypoints are special cases of the
+            # matchers, e.g. without ratio test, and are matched alone
+            single = [min(num_keypoints(x[2], i) for i in range(2)) < 2
+                      for x in chunk]
+            groups = [[x for x, s in zip(chunk, single) if not s]]
+            groups += [[x] for x, s in zip(chunk, single) if s]
+        else:
+            def shapes(item):
+                return tuple((k, v.shape) for k, v in sorted(item[2].items()))
+            chunk.sort(key=shapes)
+            groups = [list(g) for _, g in itertools.groupby(chunk, shapes)]
+        for group in groups:
+            for i in range(0, len(group), batch_size):
+                yield group[i:i+batch_size]
+
+
+def collate_pairs(datas: List[Dict]) -> Dict:
+    '''Batch the inputs of several pairs. The local features are padded to
+    the largest number of keypoints and masked with mask0 and mask1.'''
+    if len(datas) == 1:
+        return datas[0]
+    batch = {}
+    device = datas[0]['descriptors0'].device
+    for i in range(2):
+        num = torch.tensor([num_keypoints(d, i) for d in datas], device=device)
+        batch[f'mask{i}'] = torch.arange(
+            num.max(), device=device)[None] < num[:, None]
+    for k in datas[0]:
+        tensors = [d[k] for d in datas]
+        if k.startswith('image') and k[5:] in ['0', '1']:
+            # only the size of the images is used
+            size = [max(s) for s in zip(*[t.shape[1:] for t in tensors])]
+            batch[k] = torch.empty(1).expand(len(tensors), *size)
+            continue
+        dim = keypoint_dims.get(k[:-1])
+        if dim is not None:
+            num = max(t.shape[dim] for t in tensors)
+            tensors = [torch.nn.functional.pad(
+                t, (0, 0) * (t.dim() - dim - 1) + (0, num - t.shape[dim]))
+                for t in tensors]
+        batch[k] = torch.cat(tensors, 0)
+    return batch
+
+
+def group_by_query(pairs: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+    '''Make the pairs of each query consecutive, in the order in which the
+    queries first appear.'''
+    groups = {}
+    for name0, name1 in pairs:
+        groups.setdefault(name0, []).append((name0, name1))
+    return [pair for group in groups.values() for pair in group]
+
+
+def group_references(items: Iterable[Tuple[str, str, Dict]],
+                     batch_size: int) -> Iterator[List[Tuple]]:
+    '''Group consecutive pairs with the same query into batches of at most
+    batch_size references. Pairs with fewer than 2 keypoints are matched
+    alone, as in group_pairs.'''
+    batch = []
+    for item in items:
+        if min(num_keypoints(item[2], i) for i in range(2)) < 2:
+            yield [item]
+            continue
+        if len(batch) > 0 and (batch[0][0] != item[0]
+                               or len(batch) == batch_size):
+            yield batch
+            batch = []
+        batch.append(item)
+    if len(batch) > 0:
+        yield batch
+
+
+def collate_references(datas: List[Dict]) -> Dict:
+    '''Batch the inputs of pairs with the same query for the one-to-many
+    matching: the descriptors of the references are concatenated and the
+    keypoints of each reference are marked by mask1.'''
+    if len(datas) == 1:
+        return datas[0]
+    device = datas[0]['descriptors0'].device
+    num = torch.tensor([num_keypoints(d, 1) for d in datas], device=device)
+    return {
+        'descriptors0': datas[0]['descriptors0'],
+        'descriptors1': torch.cat([d['descriptors1'] for d in datas], -1),
+        'mask1': torch.arange(num.max(), device=device)[None] < num[:, None],
+    }
+
+
 @torch.no_grad()
 def match_from_paths(conf: Dict,
                      pairs_path: Path,
                      match_path: Path,
                      feature_path_q: Path,
                      feature_paths_refs: Path,
-                     overwrite: bool = False) -> Path:
+                     overwrite: bool = False,
+                     storage: Optional[Union[str, Dict]] = None,
+                     feature_cache_gb: float = 1.,
+                     num_workers: int = 0,
+                     queue_size: int = 16,
+                     batch_size: int = 1,
+                     one_to_many: bool = False) -> Path:
     logger.info('Matching local features with configuration:'
                 f'\n{pprint.pformat(conf)}')
 
@@ -131,6 +261,8 @@ def match_from_paths(conf: Dict,
     for path in feature_paths_refs:
         if not path.exists():
             raise FileNotFoundError(f'Reference feature file {path}.')
+    # sharded feature stores are replaced by their shards
+    feature_paths_refs = expand_h5_paths(feature_paths_refs)
     name2ref = {n: i for i, p in enumerate(feature_paths_refs)
                 for n in list_h5_names(p)}
     match_path.parent.mkdir(exist_ok=True, parents=True)
@@ -142,40 +274,67 @@ def match_from_paths(conf: Dict,
     if len(pairs) == 0:
         logger.info('Skipping the matching.')
         return
+    # Order the pairs such that most features are read only once.
+    name = pairs[0][0]
+    with h5py.File(str(resolve_h5_path(feature_path_q, name)), 'r') as fd:
+        size = 4 * sum(d.size for d in fd[name].values())  # as float32
+    pairs = schedule_pairs(pairs, max(int(feature_cache_gb * 1e9 / size), 2))
 
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    Model = dynamic_load(matchers, conf['model']['name'])
-    model = Model(conf['model']).eval().to(device)
+    model = get_model(matchers, conf['model'], device)
+    if one_to_many:
+        if not model.supports_one_to_many:
+            raise ValueError(f'The matcher {conf["model"]["name"]} does not'
+                             ' support the one-to-many matching.')
+        # Each query is matched to batch_size references at once.
+        pairs = group_by_query(pairs)
+
+    # Images appear in many pairs: keep their features on the device.
+    def to_device(data):
+        return {k: torch.from_numpy(v).float().to(device)
+                for k, v in data.items()}
+    reader = FeatureReader(feature_cache_gb * 1e9, to_device)
 
-    for (name0, name1) in tqdm(pairs, smoothing=.1):
+    def read_pair(pair):
+        name0, name1 = pair
         data = {}
-        with h5py.File(str(feature_path_q), 'r') as fd:
-            grp = fd[name0]
-            for k, v in grp.items():
-                data[k+'0'] = torch.from_numpy(v.__array__()).float().to(device)
+        feats0 = reader.read(resolve_h5_path(feature_path_q, name0), name0)
+        feats1 = reader.read(feature_paths_refs[name2ref[name1]], name1)
+        for i, feats in enumerate([feats0, feats1]):
+            data.update({k+str(i): v for k, v in feats.items()})
             # some matchers might expect an image but only use its size
-            data['image0'] = torch.empty((1,)+tuple(grp['image_size'])[::-1])
-        with h5py.File(str(feature_paths_refs[name2ref[name1]]), 'r') as fd:
-            grp = fd[name1]
-            for k, v in grp.items():
-                data[k+'1'] = torch.from_numpy(v.__array__()).float().to(device)
-            data['image1'] = torch.empty((1,)+tuple(grp['image_size'])[::-1])
-        data = {k: v[None] for k, v in data.items()}
-
-        pred = model(data)
-        pair = names_to_pair(name0, name1)
-        with h5py.File(str(match_path), 'a') as fd:
-            if pair in fd:
-                del fd[pair]
-            grp = fd.create_group(pair)
-            matches = pred['matches0'][0].cpu().short().numpy()
-            grp.create_dataset('matches0', data=matches)
-
-            if 'matching_scores0' in pred:
-                scores = pred['matching_scores0'][0].cpu().half().numpy()
-                grp.create_dataset('matching_scores0', data=scores)
-
-    logger.info('Finished exporting matches.')
+            size = feats['image_size'].int().tolist()
+            data[f'image{i}'] = torch.empty(1).expand((1,)+tuple(size)[::-1])
+        return name0, name1, {k: v[None] for k, v in data.items()}
+
+    # With num_workers > 0, threads read the features of the next pairs
+    # while the matcher runs. The matches are written by a background thread.
+    # The threads can fragment the heap, which the caller can limit once for
+    # the whole process with utils.io.limit_heap_fragmentation.
+    writer = FeatureWriter(match_path, queue_size, storage=storage)
+    loader = prefetch(read_pair, pairs, num_workers, queue_size)
+    if one_to_many:
+        batches = group_references(loader, batch_size)
+        collate = collate_references
+    else:
+        batches = group_pairs(loader, batch_size, model.supports_padding)
+        collate = collate_pairs
+    with reader, writer, contextlib.closing(loader), \
+            tqdm(total=len(pairs), smoothing=.1) as pbar:
+        for batch in batches:
+            pred = model(collate([data for _, _, data in batch]))
+            for b, (name0, name1, data) in enumerate(batch):
+                n = num_keypoints(data, 0)  # without the padding
+                pair = names_to_pair(name0, name1)
+                matches = {
+                    'matches0': pred['matches0'][b, :n].cpu().short().numpy()}
+                if 'matching_scores0' in pred:
+                    matches['matching_scores0'] = (
+                        pred['matching_scores0'][b, :n].cpu().half().numpy())
+                writer.write(pair, matches)
+            pbar.update(len(batch))
+
+    logger.info('Finished exporting matches, %s.', reader.summary())
 
 
 if __name__ == '__main__':
@@ -187,5 +346,34 @@ if __name__ == '__main__':
     parser.add_argument('--matches', type=Path)
     parser.add_argument('--conf', type=str, default='superglue',
                         choices=list(confs.keys()))
+    parser.add_argument('--storage', type=str,
+                        choices=list(storage_profiles.keys()),
+                        help='Chunking and compression of the datasets')
+    parser.add_argument('--feature_cache_gb', type=float, default=1.)
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help='Threads reading the features in advance. '
+                        'They can fragment the heap, see '
+                        '--limit_heap_fragmentation')
+    parser.add_argument('--limit_heap_fragmentation', action='store_true',
+                        help='Allocate the large buffers with mmap for the '
+                        'whole process (glibc only), such that the memory '
+                        'usage does not grow with num_workers > 0')
+    parser.add_argument('--queue_size', type=int, default=16,
+                        help='Number of pairs read or written in advance')
+    parser.add_argument('--batch_size', type=int, default=1,
+                        help='Number of pairs matched in a single forward')
+    parser.add_argument('--one_to_many', action='store_true',
+                        help='Match each query to batch_size references '
+                        'at once (nearest_neighbor only)')
     args = parser.parse_args()
-    main(confs[args.conf], args.pairs, args.features, args.export_dir)
+    if args.limit_heap_fragmentation and not limit_heap_fragmentation():
+        logger.warning('Cannot limit the heap fragmentation: the allocator '
+                       'is not glibc.')
+    elif args.num_workers > 0 and not args.limit_heap_fragmentation:
+        logger.warning('Reading the features in threads can fragment the '
+                       'heap and grow the memory usage by GBs, consider '
+                       '--limit_heap_fragmentation or --num_workers 0.')
+    main(confs[args.conf], args.pairs, args.features, args.export_dir,
+         storage=args.storage, feature_cache_gb=args.feature_cache_gb,
+         num_workers=args.num_workers, queue_size=args.queue_size,
+         batch_size=args.batch_size, one_to_many=args.one_to_many)
@@ -31,6 +31,8 @@ class NearestNeighbor(BaseModel):
         'do_mutual_check': True,
     }
     required_inputs = ['descriptors0', 'descriptors1']
+    supports_padding = True
+    supports_one_to_many = True
 
     def _init(self, conf):
         pass
@@ -49,6 +51,12 @@ class NearestNeighbor(BaseModel):
             ratio_threshold = None
         sim = torch.einsum(
             'bdn,bdm->bnm', data['descriptors0'], data['descriptors1'])
+        if 'mask0' in data:  # padded keypoints are never matched
+            sim.masked_fill_(~data['mask0'][:, :, None], -float('inf'))
+            sim.masked_fill_(~data['mask1'][:, None], -float('inf'))
+        elif 'mask1' in data:  # one query against several references
+            return self._forward_one_to_many(
+                sim[0], data['mask1'].sum(-1).tolist(), ratio_threshold)
         matches0, scores0 = find_nn(
             sim, ratio_threshold, self.conf['distance_threshold'])
         if self.conf['do_mutual_check']:
@@ -60,3 +68,25 @@ class NearestNeighbor(BaseModel):
             'matches0': matches0,
             'matching_scores0': scores0,
         }
+
+    def _forward_one_to_many(self, sim, sizes, ratio_threshold):
+        '''Split the similarity between a query and the concatenated
+        keypoints of the references into the matches to each reference.
+        The references are matched back to the query all at once, so each
+        of them must have at least 2 keypoints, as for the ratio test.'''
+        if self.conf['do_mutual_check']:
+            matches1, _ = find_nn(
+                sim.t(), ratio_threshold, self.conf['distance_threshold'])
+            matches1 = torch.split(matches1, sizes)
+        matches0, scores0 = [], []
+        for i, sim_i in enumerate(torch.split(sim, sizes, dim=1)):
+            m0, s0 = find_nn(
+                sim_i, ratio_threshold, self.conf['distance_threshold'])
+            if self.conf['do_mutual_check']:
+                m0 = mutual_check(m0, matches1[i])
+            matches0.append(m0)
+            scores0.append(s0)
+        return {
+            'matches0': torch.stack(matches0),
+            'matching_scores0': torch.stack(scores0),
+        }
@@ -0,0 +1,63 @@
+import argparse
+from pathlib import Path
+from typing import Optional
+import h5py
+from tqdm import tqdm
+
+from . import logger
+from .utils.io import (
+    read_manifest, write_manifest, manifest_path, append_name_index,
+    list_h5_names, shard_path, mark_shard, MANIFEST_SUFFIX)
+
+
+def main(manifest: Path, output: Optional[Path] = None,
+         overwrite: bool = False) -> Path:
+    '''Merge the shards of a sharded feature store into a single file.'''
+    shards, name2shard = read_manifest(manifest)
+    if output is None:
+        output = manifest.parent / (
+            manifest.name[:-len(MANIFEST_SUFFIX)] + '.h5')
+    if output.exists() and not overwrite:
+        raise FileExistsError(f'The output file {output} already exists.')
+    logger.info('Merging %d shards with %d images into %s.',
+                len(shards), len(name2shard), output)
+
+    with h5py.File(str(output), 'w') as fd_out:
+        for shard in tqdm(shards):
+            with h5py.File(str(shard), 'r') as fd:
+                names = list_h5_names(shard)
+                for name in names:
+                    parent, base = Path(name).parent, Path(name).name
+                    group = fd_out
+                    if parent != Path('.'):
+                        group = fd_out.require_group(parent.as_posix())
+                    fd.copy(fd[name], group, name=base)
+                append_name_index(fd_out, names)
+    logger.info('Finished merging the shards.')
+    return output
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--feature_path', type=Path, required=True,
+                        help='Path of the store, as given to extract_features')
+    parser.add_argument('--num_shards', type=int, required=True)
+    parser.add_argument('--output', type=Path)
+    parser.add_argument('--manifest_only', action='store_true',
+                        help='Only (re)write the manifest of the store')
+    parser.add_argument('--overwrite', action='store_true')
+    parser.add_argument('--mark_complete', action='store_true',
+                        help='Mark all the existing shards as complete, '
+                        'e.g. if they were written by an older version')
+    args = parser.parse_args()
+
+    if args.mark_complete:
+        for i in range(args.num_shards):
+            shard = shard_path(args.feature_path, i, args.num_shards)
+            if shard.exists():
+                mark_shard(shard)
+
+    if not write_manifest(args.feature_path, args.num_shards):
+        raise ValueError('Some shards are missing or still being written.')
+    if not args.manifest_only:
+        main(manifest_path(args.feature_path), args.output, args.overwrite)
@@ -1,15 +1,17 @@
 import argparse
 from pathlib import Path
-from typing import Optional
-import h5py
+from typing import Optional, TYPE_CHECKING
 import numpy as np
-import torch
 import collections.abc as collections
 
 from . import logger
 from .utils.parsers import parse_image_lists
 from .utils.read_write_model import read_images_binary
-from .utils.io import list_h5_names
+from .utils.io import (
+    list_h5_names, expand_h5_paths, resolve_h5_path, read_stacked)
+
+if TYPE_CHECKING:  # imported lazily since it is slow
+    import torch
 
 
 def parse_names(prefix, names, names_all):
@@ -31,21 +33,20 @@ def parse_names(prefix, names, names_all):
 
 
 def get_descriptors(names, path, name2idx=None, key='global_descriptor'):
+    import torch
     if name2idx is None:
-        with h5py.File(str(path), 'r') as fd:
-            desc = [fd[n][key].__array__() for n in names]
+        paths = [resolve_h5_path(path, n) for n in names]
     else:
-        desc = []
-        for n in names:
-            with h5py.File(str(path[name2idx[n]]), 'r') as fd:
-                desc.append(fd[n][key].__array__())
-    return torch.from_numpy(np.stack(desc, 0)).float()
+        paths = [path[name2idx[n]] for n in names]
+    desc = read_stacked(names, paths, key)
+    return torch.from_numpy(desc).float()
 
 
-def pairs_from_score_matrix(scores: torch.Tensor,
+def pairs_from_score_matrix(scores: 'torch.Tensor',
                             invalid: np.array,
                             num_select: int,
                             min_score: Optional[float] = None):
+    import torch
     assert scores.shape == invalid.shape
     if isinstance(scores, np.ndarray):
         scores = torch.from_numpy(scores)
@@ -66,15 +67,21 @@ def pairs_from_score_matrix(scores: torch.Tensor,
 
 def main(descriptors, output, num_matched,
          query_prefix=None, query_list=None,
-         db_prefix=None, db_list=None, db_model=None, db_descriptors=None):
+         db_prefix=None, db_list=None, db_model=None, db_descriptors=None,
+         min_score: Optional[float] = 0):
+    '''Retrieve the num_matched most similar database images of each query.
+    Pairs with a similarity below min_score are dropped. Use None for the
+    PCA-whitened descriptors of compress_global_features, which are
+    mean-centred, such that unrelated images have negative similarities.'''
+    import torch
     logger.info('Extracting image pairs from a retrieval database.')
 
     # We handle multiple reference feature files.
     # We only assume that names are unique among them and map names to files.
     if db_descriptors is None:
         db_descriptors = descriptors
-    if isinstance(db_descriptors, (Path, str)):
-        db_descriptors = [db_descriptors]
+    # sharded descriptor stores are replaced by their shards
+    db_descriptors = expand_h5_paths(db_descriptors)
     name2db = {n: i for i, p in enumerate(db_descriptors)
                for n in list_h5_names(p)}
     db_names_h5 = list(name2db.keys())
@@ -96,7 +103,7 @@ def main(descriptors, output, num_matched,
 
     # Avoid self-matching
     self = np.array(query_names)[:, None] == np.array(db_names)[None]
-    pairs = pairs_from_score_matrix(sim, self, num_matched, min_score=0)
+    pairs = pairs_from_score_matrix(sim, self, num_matched, min_score)
     pairs = [(query_names[i], db_names[j]) for i, j in pairs]
 
     logger.info(f'Found {len(pairs)} pairs.')
@@ -115,5 +122,11 @@ if __name__ == "__main__":
     parser.add_argument('--db_list', type=Path)
     parser.add_argument('--db_model', type=Path)
     parser.add_argument('--db_descriptors', type=Path)
+    parser.add_argument('--min_score', type=float, default=0)
+    parser.add_argument('--no_min_score', action='store_true',
+                        help='Keep the pairs of any similarity, e.g. for '
+                        'PCA-whitened descriptors')
     args = parser.parse_args()
+    if args.__dict__.pop('no_min_score'):
+        args.min_score = None
     main(**args.__dict__)
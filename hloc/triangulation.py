@@ -1,5 +1,6 @@
 import argparse
 import contextlib
+import functools
 import io
 import sys
 from pathlib import Path
@@ -11,6 +12,7 @@ from . import logger
 from .utils.database import COLMAPDatabase
 from .utils.io import get_keypoints, get_matches
 from .utils.parsers import parse_retrieval
+from .utils.pairs import schedule_pairs
 from .utils.geometry import compute_epipolar_errors
 
 
@@ -103,51 +105,52 @@ def estimation_and_geometric_verification(database_path, pairs_path,
 
 
 def geometric_verification(image_ids, reference, database_path, features_path,
-                           pairs_path, matches_path, max_error=4.0):
+                           pairs_path, matches_path, max_error=4.0,
+                           cache_size=1024):
     logger.info('Performing geometric verification of the matches...')
 
     pairs = parse_retrieval(pairs_path)
+    unique_pairs = {}
+    for name0, names1 in pairs.items():
+        for name1 in names1:
+            id0, id1 = image_ids[name0], image_ids[name1]
+            if (id1, id0) not in unique_pairs:
+                unique_pairs.setdefault((id0, id1), (name0, name1))
+    # Visit the pairs such that the keypoints of each image are read once.
+    pairs = schedule_pairs(list(unique_pairs.values()), cache_size)
     db = COLMAPDatabase.connect(database_path)
 
+    @functools.lru_cache(maxsize=cache_size)
+    def read_keypoints(name):
+        image = reference.images[image_ids[name]]
+        cam = reference.cameras[image.camera_id]
+        kps, noise = get_keypoints(
+            features_path, name, return_uncertainty=True)
+        kps = np.array([cam.image_to_world(kp) for kp in kps])
+        return image, cam, kps, noise
+
     inlier_ratios = []
-    matched = set()
-    for name0 in tqdm(pairs):
-        id0 = image_ids[name0]
-        image0 = reference.images[id0]
-        cam0 = reference.cameras[image0.camera_id]
-        kps0, noise0 = get_keypoints(
-            features_path, name0, return_uncertainty=True)
-        kps0 = np.array([cam0.image_to_world(kp) for kp in kps0])
-
-        for name1 in pairs[name0]:
-            id1 = image_ids[name1]
-            image1 = reference.images[id1]
-            cam1 = reference.cameras[image1.camera_id]
-            kps1, noise1 = get_keypoints(
-                features_path, name1, return_uncertainty=True)
-            kps1 = np.array([cam1.image_to_world(kp) for kp in kps1])
-
-            matches = get_matches(matches_path, name0, name1)[0]
-
-            if len({(id0, id1), (id1, id0)} & matched) > 0:
-                continue
-            matched |= {(id0, id1), (id1, id0)}
-
-            if matches.shape[0] == 0:
-                db.add_two_view_geometry(id0, id1, matches)
-                continue
-
-            qvec_01, tvec_01 = pycolmap.relative_pose(
-                image0.qvec, image0.tvec, image1.qvec, image1.tvec)
-            _, errors0, errors1 = compute_epipolar_errors(
-                qvec_01, tvec_01, kps0[matches[:, 0]], kps1[matches[:, 1]])
-            valid_matches = np.logical_and(
-                errors0 <= max_error * noise0 / cam0.mean_focal_length(),
-                errors1 <= max_error * noise1 / cam1.mean_focal_length())
-            # TODO: We could also add E to the database, but we need
-            # to reverse the transformations if id0 > id1 in utils/database.py.
-            db.add_two_view_geometry(id0, id1, matches[valid_matches, :])
-            inlier_ratios.append(np.mean(valid_matches))
+    for name0, name1 in tqdm(pairs):
+        id0, id1 = image_ids[name0], image_ids[name1]
+        image0, cam0, kps0, noise0 = read_keypoints(name0)
+        image1, cam1, kps1, noise1 = read_keypoints(name1)
+        matches = get_matches(matches_path, name0, name1)[0]
+
+        if matches.shape[0] == 0:
+            db.add_two_view_geometry(id0, id1, matches)
+            continue
+
+        qvec_01, tvec_01 = pycolmap.relative_pose(
+            image0.qvec, image0.tvec, image1.qvec, image1.tvec)
+        _, errors0, errors1 = compute_epipolar_errors(
+            qvec_01, tvec_01, kps0[matches[:, 0]], kps1[matches[:, 1]])
+        valid_matches = np.logical_and(
+            errors0 <= max_error * noise0 / cam0.mean_focal_length(),
+            errors1 <= max_error * noise1 / cam1.mean_focal_length())
+        # TODO: We could also add E to the database, but we need
+        # to reverse the transformations if id0 > id1 in utils/database.py.
+        db.add_two_view_geometry(id0, id1, matches[valid_matches, :])
+        inlier_ratios.append(np.mean(valid_matches))
     logger.info('mean/med/min/max valid matches %.2f/%.2f/%.2f/%.2f%%.',
                 np.mean(inlier_ratios) * 100, np.median(inlier_ratios) * 100,
                 np.min(inlier_ratios) * 100, np.max(inlier_ratios) * 100)
@@ -1,13 +1,23 @@
 import sys
 from abc import ABCMeta, abstractmethod
+from typing import Dict, Optional
+import torch
 from torch import nn
 from copy import copy
 import inspect
+import json
 
 
 class BaseModel(nn.Module, metaclass=ABCMeta):
     default_conf = {}
     required_inputs = []
+    # Whether a batch of pairs can have different numbers of keypoints,
+    # padded and masked by the boolean B x N inputs mask0 and mask1.
+    supports_padding = False
+    # Whether a query can be matched to B references at once, given the
+    # 1 x D x M descriptors1 of all the references concatenated and the
+    # boolean B x N input mask1 of the keypoints of each reference.
+    supports_one_to_many = False
 
     def __init__(self, conf):
         """Perform some logic and call the _init method of the child model."""
@@ -23,6 +33,11 @@ class BaseModel(nn.Module, metaclass=ABCMeta):
             assert key in data, 'Missing key {} in data'.format(key)
         return self._forward(data)
 
+    def release(self):
+        """Release the resources held outside of the model, e.g. worker
+        processes, when it is evicted by evict_models."""
+        pass
+
     @abstractmethod
     def _init(self, conf):
         """To be implemented by the child class."""
@@ -45,3 +60,29 @@ def dynamic_load(root, model):
     assert len(classes) == 1, classes
     return classes[0][1]
     # return getattr(module, 'Model')
+
+
+# Models constructed in this process, by root, configuration, and device.
+_models = {}
+
+
+def get_model(root, conf: Dict, device: str = 'cpu') -> BaseModel:
+    """Construct a model in eval mode, or reuse the one that was constructed
+    with the same configuration, until it is evicted by evict_models."""
+    key = (root.__name__, json.dumps(conf, sort_keys=True, default=str),
+           str(device))
+    if key not in _models:
+        Model = dynamic_load(root, conf['name'])
+        _models[key] = Model(conf).eval().to(device)
+    return _models[key]
+
+
+def evict_models(name: Optional[str] = None) -> int:
+    """Release the models with a given name, or all the models."""
+    keys = [k for k in _models
+            if name is None or json.loads(k[1])['name'] == name]
+    for key in keys:
+        _models.pop(key).release()
+    if len(keys) > 0 and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    return len(keys)
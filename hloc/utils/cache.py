@@ -0,0 +1,99 @@
+from typing import Dict, List, Optional, Tuple
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import os
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ATTRS_KEY = '__attrs__'
+
+
+def hash_file(path: Path, chunk_size: int = 1 << 20) -> str:
+    h = hashlib.sha1()
+    with open(str(path), 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hash_conf(conf: Dict) -> str:
+    conf = json.dumps(conf, sort_keys=True, default=str)
+    return hashlib.sha1(conf.encode()).hexdigest()[:16]
+
+
+class ExtractionCache:
+    '''A local cache of extracted features, shared across output files.
+    Entries are keyed by the content of the image and by the configuration
+    of the extraction, such that features computed for the same image with
+    the same model are reused independently of the image name or location.
+    The least recently used entries are evicted when the cache exceeds its
+    maximum size.
+    '''
+    def __init__(self, root: Path, conf: Dict, max_size_gb: float = 50.):
+        self.root = Path(root)
+        self.dir = self.root / hash_conf(conf)
+        self.dir.mkdir(exist_ok=True, parents=True)
+        self.max_size = int(max_size_gb * 1e9)
+        self.size = sum(size for _, _, size in self._entries())
+        self.hits = self.misses = 0
+
+    def keys(self, paths: List[Path], num_threads: int = 8) -> List[str]:
+        with ThreadPoolExecutor(num_threads) as executor:
+            return list(executor.map(hash_file, paths))
+
+    def _path(self, key: str) -> Path:
+        return self.dir / key[:2] / f'{key}.npz'
+
+    def get(self, key: str) -> Optional[Tuple[Dict, Dict]]:
+        path = self._path(key)
+        try:
+            with np.load(str(path)) as entry:
+                pred = {k: entry[k] for k in entry.files if k != ATTRS_KEY}
+                attrs = json.loads(str(entry[ATTRS_KEY]))
+            os.utime(str(path))  # mark as recently used
+        except Exception:  # missing, or evicted by a concurrent process
+            self.misses += 1
+            return None
+        self.hits += 1
+        return pred, attrs
+
+    def put(self, key: str, pred: Dict[str, np.ndarray], attrs: Dict):
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        tmp_path = path.parent / f'{key}.{os.getpid()}.tmp.npz'
+        attrs = json.dumps(attrs, default=float)
+        np.savez(str(tmp_path), **pred, **{ATTRS_KEY: np.array(attrs)})
+        os.replace(str(tmp_path), str(path))  # atomic for concurrent readers
+        self.size += path.stat().st_size
+        if self.size > self.max_size:
+            self.evict()
+
+    def _entries(self):
+        for dirpath, _, filenames in os.walk(str(self.root)):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_mtime, stat.st_size
+
+    def evict(self, target_ratio: float = 0.9):
+        '''Remove the least recently used entries of all configurations.'''
+        entries = sorted(self._entries(), key=lambda e: e[1])
+        self.size = sum(size for _, _, size in entries)
+        num_evicted = 0
+        for path, _, size in entries:
+            if self.size <= target_ratio * self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+            num_evicted += 1
+        logger.info('Evicted %d entries from the feature cache.', num_evicted)
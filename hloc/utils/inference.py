@@ -0,0 +1,303 @@
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from pathlib import Path
+import copy
+import json
+import logging
+import os
+import time
+import cv2
+import numpy as np
+import torch
+from torch import nn
+
+from .tools import map_tensor
+from .io import read_image
+from .cache import hash_conf
+
+logger = logging.getLogger(__name__)
+
+'''
+Options of the CPU inference mode of the dense networks of the extractors:
+    - num_threads: number of intra-op threads, by default all the cores.
+    - channels_last: run the convolutions with NHWC tensors, which is the
+      native layout of the oneDNN kernels and avoids reordering each layer.
+    - compile: 'script' to convert the network with TorchScript or
+      'compile' to optimize it with torch.compile (PyTorch>=2.0).
+    - bfloat16: run the network under bfloat16 autocast, which is fast on
+      CPUs with AVX512-BF16 or AMX instructions but changes the outputs.
+'''
+cpu_default_conf = {
+    'num_threads': None,
+    'channels_last': False,
+    'compile': None,
+    'bfloat16': False,
+}
+
+
+class CPUInference(nn.Module):
+    '''Run a network with images as input with CPU-specific optimizations.
+    The outputs are always returned as contiguous float32 tensors.
+    '''
+    def __init__(self, net: nn.Module, conf: Optional[Dict] = None):
+        super().__init__()
+        self.conf = conf = {**cpu_default_conf, **(conf or {})}
+        if conf['num_threads'] is not None:
+            torch.set_num_threads(conf['num_threads'])
+        if conf['channels_last']:
+            net = net.to(memory_format=torch.channels_last)
+        if conf['compile'] == 'script':
+            net = torch.jit.script(net)
+        elif conf['compile'] == 'compile':
+            if not hasattr(torch, 'compile'):
+                raise ValueError('torch.compile requires PyTorch>=2.0.')
+            net = torch.compile(net, dynamic=True)
+        elif conf['compile'] is not None:
+            raise ValueError(f'Unknown compilation mode {conf["compile"]}.')
+        self.net = net
+        logger.info('CPU inference with %d threads and options %s.',
+                    torch.get_num_threads(), conf)
+
+    def forward(self, image: torch.Tensor):
+        if self.conf['channels_last']:
+            image = image.contiguous(memory_format=torch.channels_last)
+        with torch.autocast('cpu', dtype=torch.bfloat16,
+                            enabled=self.conf['bfloat16']):
+            outputs = self.net(image)
+        return map_tensor(
+            outputs, lambda x: x.float().contiguous())
+
+
+'''
+Options of the int8 post-training quantization of the dense networks:
+    - calibration_dir: directory of images on which the ranges of the
+      activations are calibrated, ideally from the same domain as the
+      images to extract. extract_features uses its image_dir by default.
+    - num_images: number of calibration images, evenly sampled.
+    - resize_max: size of the calibration images, as for the extraction.
+    - cache_dir: where the calibrated models are stored, by default in the
+      cache of torch.hub. The cache is keyed by the network, the options,
+      and the names of the calibration images.
+'''
+int8_default_conf = {
+    'calibration_dir': None,
+    'num_images': 32,
+    'resize_max': 1024,
+    'cache_dir': None,
+}
+image_extensions = ['.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff']
+
+
+def list_calibration_images(image_dir: Path, num: int) -> List[Path]:
+    paths = sorted(p for p in Path(image_dir).glob('**/*')
+                   if p.suffix.lower() in image_extensions)
+    if len(paths) == 0:
+        raise ValueError(f'Could not find any image in {image_dir}.')
+    step = max(len(paths) // num, 1)
+    return paths[::step][:num]
+
+
+def iter_calibration_images(paths: List[Path], grayscale: bool,
+                            resize_max: int) -> Iterator[torch.Tensor]:
+    for path in paths:
+        image = read_image(path, grayscale)
+        scale = resize_max / max(image.shape[:2]) if resize_max else 1
+        if scale < 1:
+            size = tuple(int(round(x*scale)) for x in image.shape[:2][::-1])
+            image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        image = torch.from_numpy(image.astype('float32') / 255.)
+        image = image[None] if grayscale else image.permute(2, 0, 1)
+        yield image[None]
+
+
+def quantize_int8(net: nn.Module, conf: Dict, name: str, grayscale: bool,
+                  preprocess: Optional[Callable] = None,
+                  float_layers: List[str] = ()) -> nn.Module:
+    '''Static post-training quantization of a network to int8.
+    The inputs and outputs remain float32 tensors. The calibrated network
+    is cached to disk. Layers in float_layers are not quantized.
+    Quantized networks can only run on CPU.
+    '''
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    conf = {**int8_default_conf, **conf}
+    if conf['calibration_dir'] is None:
+        raise ValueError('The int8 quantization requires calibration images.')
+    paths = list_calibration_images(
+        conf['calibration_dir'], conf['num_images'])
+    key = hash_conf({
+        'name': name, 'float_layers': list(float_layers),
+        'resize_max': conf['resize_max'], 'torch': torch.__version__,
+        'images': [p.relative_to(conf['calibration_dir']).as_posix()
+                   for p in paths]})
+    cache_dir = conf['cache_dir']
+    if cache_dir is None:
+        cache_dir = Path(torch.hub.get_dir(), 'hloc')
+    cache_path = Path(cache_dir, f'{name}-int8-{key}.pth')
+
+    engine = 'x86'
+    if engine not in torch.backends.quantized.supported_engines:
+        engine = 'qnnpack'
+    torch.backends.quantized.engine = engine
+    mapping = get_default_qconfig_mapping(engine)
+    for layer in float_layers:
+        mapping.set_module_name(layer, None)
+    example = torch.zeros(1, 1 if grayscale else 3, 64, 64)
+    net = prepare_fx(copy.deepcopy(net).cpu().eval(), mapping, (example,))
+
+    if cache_path.exists():
+        net = convert_fx(net)
+        net.load_state_dict(torch.load(str(cache_path), weights_only=False))
+        logger.info('Loaded the int8 %s from %s.', name, cache_path)
+        return net
+
+    logger.info('Calibrating the int8 %s on %d images.', name, len(paths))
+    with torch.no_grad():
+        for image in iter_calibration_images(
+                paths, grayscale, conf['resize_max']):
+            net(image if preprocess is None else preprocess(image))
+    net = convert_fx(net)
+    cache_path.parent.mkdir(exist_ok=True, parents=True)
+    tmp_path = cache_path.with_suffix(f'.{os.getpid()}.tmp')
+    torch.save(net.state_dict(), str(tmp_path))
+    os.replace(str(tmp_path), str(cache_path))
+    return net
+
+
+def keypoint_repeatability(kpts0: np.ndarray, kpts1: np.ndarray,
+                           desc0: np.ndarray, desc1: np.ndarray,
+                           threshold: float) -> Tuple[float, float, float]:
+    '''Fraction of the keypoints of a reference with a keypoint within
+    threshold pixels in the other set, and the mean cosine similarity and
+    the maximum absolute difference of the descriptors of these keypoints.'''
+    if len(kpts0) == 0 or len(kpts1) == 0:
+        return float(len(kpts0) == len(kpts1)), 1., 0.
+    dist = torch.cdist(torch.from_numpy(kpts0).float(),
+                       torch.from_numpy(kpts1).float())
+    dist, nearest = dist.min(1)
+    valid = (dist <= threshold).numpy()
+    if not valid.any():
+        return 0., 0., float('inf')
+    desc0, desc1 = desc0[:, valid], desc1[:, nearest.numpy()[valid]]
+    cosine = (desc0 * desc1).sum(0) / (
+        np.linalg.norm(desc0, axis=0) * np.linalg.norm(desc1, axis=0))
+    return (float(valid.mean()), float(cosine.mean()),
+            float(np.abs(desc0 - desc1).max()))
+
+
+def retrieval_overlap(desc0: np.ndarray, desc1: np.ndarray, k: int) -> float:
+    '''Overlap of the top-k neighbors of each image among all the others,
+    retrieved with two sets of N x D global descriptors.'''
+    k = min(k, len(desc0) - 1)
+    topk = []
+    for desc in [desc0, desc1]:
+        sim = desc @ desc.T
+        np.fill_diagonal(sim, -np.inf)  # no self-retrieval
+        topk.append(np.argsort(-sim, 1)[:, :k])
+    return np.mean([len(np.intersect1d(i, j)) / k for i, j in zip(*topk)])
+
+
+def compare_extraction(conf: Dict, conf_other: Dict, label: str,
+                       image_dir: Path, export_dir: Path, k: int = 5,
+                       threshold: float = 3.) -> Dict[str, float]:
+    '''Extract features with two configurations of the same model on the
+    same images and report the speed and the accuracy of the second one
+    w.r.t. the first. Each extraction is timed on a second run, such that
+    the construction of the models, reused across calls, is not included.
+    Local features: keypoint repeatability and descriptor similarity.
+    Global descriptors: overlap of the top-k retrieved images.'''
+    import h5py
+    from .. import extract_features
+    from .io import list_h5_names, read_array
+
+    paths, speeds = [], []
+    for c in [conf, conf_other]:
+        paths.append(Path(export_dir, c['output'] + '.h5'))
+        for _ in range(2):
+            start = time.time()
+            extract_features.main(c, image_dir, feature_path=paths[-1],
+                                  overwrite=True)
+        speeds.append(time.time() - start)
+    names = sorted(list_h5_names(paths[0]))
+    with h5py.File(str(paths[0]), 'r') as fd0, \
+            h5py.File(str(paths[1]), 'r') as fd1:
+        preds = [{n: {key: read_array(d) for key, d in fd[n].items()}
+                  for n in names} for fd in [fd0, fd1]]
+    metrics = {'images/s': len(names) / speeds[0],
+               f'images/s_{label}': len(names) / speeds[1]}
+    if 'global_descriptor' in preds[0][names[0]]:
+        descs = [np.stack([p[n]['global_descriptor'] for n in names])
+                 for p in preds]
+        metrics[f'top{k}_overlap'] = float(retrieval_overlap(*descs, k))
+        metrics['descriptor_drift'] = float(np.abs(descs[0] - descs[1]).max())
+    else:
+        results = np.array([keypoint_repeatability(
+            preds[0][n]['keypoints'], preds[1][n]['keypoints'],
+            preds[0][n]['descriptors'], preds[1][n]['descriptors'],
+            threshold) for n in names])
+        metrics['repeatability'], metrics['descriptor_cosine'] = map(
+            float, results[:, :2].mean(0))
+        metrics['descriptor_drift'] = float(results[:, 2].max())
+    logger.info('%s %s on %d images: %s.', label, conf['model']['name'],
+                len(names),
+                ', '.join(f'{m} {v:.4g}' for m, v in metrics.items()))
+    return metrics
+
+
+def compare_int8(conf: Dict, image_dir: Path, export_dir: Path,
+                 num_images: int = 32, k: int = 5,
+                 threshold: float = 3.) -> Dict[str, float]:
+    '''Compare the int8 model to the float one, calibrated on num_images
+    of the images to extract.'''
+    conf_int8 = {**conf, 'output': conf['output'] + '-int8', 'model': {
+        **conf['model'], 'int8': {'num_images': num_images}}}
+    return compare_extraction(
+        conf, conf_int8, 'int8', image_dir, export_dir, k, threshold)
+
+
+def compare_cpu(conf: Dict, image_dir: Path, export_dir: Path,
+                cpu_conf: Optional[Dict] = None, k: int = 5,
+                threshold: float = 3.) -> Dict[str, float]:
+    '''Compare the CPU inference mode with the given options, by default
+    channels_last, to the default inference.'''
+    if cpu_conf is None:
+        cpu_conf = {'channels_last': True}
+    conf = {**conf, 'model': {
+        key: v for key, v in conf['model'].items()
+        if key not in ['cpu', 'int8']}}
+    conf_cpu = {**conf, 'output': conf['output'] + '-cpu', 'model': {
+        **conf['model'], 'cpu': cpu_conf}}
+    return compare_extraction(
+        conf, conf_cpu, 'cpu', image_dir, export_dir, k, threshold)
+
+
+if __name__ == '__main__':
+    import argparse
+    from .. import extract_features
+
+    parser = argparse.ArgumentParser(
+        description='Compare the int8 or the CPU inference mode of '
+        'extractors to their default inference.')
+    parser.add_argument('mode', type=str, choices=['int8', 'cpu'])
+    parser.add_argument('--image_dir', type=Path, required=True)
+    parser.add_argument('--export_dir', type=Path, required=True)
+    parser.add_argument('--confs', type=str, nargs='+',
+                        default=['superpoint_aachen', 'netvlad'],
+                        choices=list(extract_features.confs.keys()))
+    parser.add_argument('--num_images', type=int, default=32,
+                        help='Number of calibration images')
+    parser.add_argument('--cpu_conf', type=json.loads,
+                        help='Options of the CPU inference mode, as JSON')
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--threshold', type=float, default=3.,
+                        help='Distance of repeated keypoints, in pixels')
+    args = parser.parse_args()
+    for name in args.confs:
+        if args.mode == 'int8':
+            compare_int8(extract_features.confs[name], args.image_dir,
+                         args.export_dir, args.num_images, args.k,
+                         args.threshold)
+        else:
+            compare_cpu(extract_features.confs[name], args.image_dir,
+                        args.export_dir, args.cpu_conf, args.k,
+                        args.threshold)
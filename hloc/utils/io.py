@@ -1,17 +1,50 @@
-from typing import Tuple
+from typing import (
+    Callable, Tuple, Dict, Optional, List, Iterable, Iterator, Union)
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import collections
+import ctypes
+import functools
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import zlib
 import numpy as np
-import cv2
 import h5py
 
 from .parsers import names_to_pair, names_to_pair_old
 
+logger = logging.getLogger(__name__)
 
-def read_image(path, grayscale=False):
+# Root dataset listing the names of all groups written by hloc.
+NAME_INDEX = '__names__'
+# A sharded feature store is made of HDF5 shards and of a JSON manifest that
+# maps each name to its shard. The manifest can be used in place of a file.
+MANIFEST_SUFFIX = '.manifest.json'
+
+# Storage profiles, as options of h5py.Group.create_dataset, that trade the
+# file size for the read latency. Chunks are clipped to the dataset shape.
+storage_profiles = {
+    'default': {},
+    'lzf': {'compression': 'lzf', 'shuffle': True},
+    'gzip': {'compression': 'gzip', 'compression_opts': 4, 'shuffle': True},
+    'gzip-fast': {'compression': 'gzip', 'compression_opts': 1},
+}
+
+
+def read_image(path, grayscale=False, reduction=1):
+    import cv2
     if grayscale:
         mode = cv2.IMREAD_GRAYSCALE
     else:
         mode = cv2.IMREAD_COLOR
+    if reduction > 1:  # JPEG images are decoded at a lower resolution
+        mode = getattr(cv2, 'IMREAD_REDUCED_{}_{}'.format(
+            'GRAYSCALE' if grayscale else 'COLOR', reduction))
     image = cv2.imread(str(path), mode)
     if image is None:
         raise ValueError(f'Cannot read image {path}.')
@@ -20,19 +53,198 @@ def read_image(path, grayscale=False):
     return image
 
 
-def list_h5_names(path):
+def read_image_size(path):
+    '''Read the (width, height) of an image from its header only.'''
+    import PIL.Image
+    with PIL.Image.open(str(path)) as image:
+        size = image.size
+        orientation = image.getexif().get(0x0112, 1)
+    if orientation in [5, 6, 7, 8]:  # OpenCV applies the EXIF rotation
+        size = size[::-1]
+    return size
+
+
+def read_name_index(fd: h5py.File) -> Optional[List[str]]:
+    if NAME_INDEX not in fd:
+        return None
+    return [n.decode() if isinstance(n, bytes) else n
+            for n in fd[NAME_INDEX][()]]
+
+
+def append_name_index(fd: h5py.File, names: Iterable[str]):
+    names = list(names)
+    if NAME_INDEX not in fd:
+        fd.create_dataset(NAME_INDEX, shape=(0,), maxshape=(None,),
+                          dtype=h5py.string_dtype(), chunks=(1024,))
+    index = fd[NAME_INDEX]
+    size = len(index)
+    index.resize((size + len(names),))
+    index[size:] = names
+
+
+def add_name_index(path: Path):
+    '''Add the name index to an existing file, or rebuild it.'''
+    with h5py.File(str(path), 'a') as fd:
+        if NAME_INDEX in fd:
+            del fd[NAME_INDEX]
+        append_name_index(fd, list_h5_names_walk(fd))
+
+
+def list_h5_names_walk(fd: h5py.File) -> List[str]:
     names = []
-    with h5py.File(str(path), 'r') as fd:
-        def visit_fn(_, obj):
-            if isinstance(obj, h5py.Dataset):
-                names.append(obj.parent.name.strip('/'))
-        fd.visititems(visit_fn)
+
+    def visit_fn(_, obj):
+        if isinstance(obj, h5py.Dataset) and obj.parent.name != '/':
+            names.append(obj.parent.name.strip('/'))
+    fd.visititems(visit_fn)
     return list(set(names))
 
 
+def list_h5_names(path):
+    if is_manifest(path):
+        return list(read_manifest(path)[1].keys())
+    with h5py.File(str(path), 'r') as fd:
+        names = read_name_index(fd)
+        if names is None:  # files written by older versions of hloc
+            names = list_h5_names_walk(fd)
+    return names
+
+
+def manifest_path(path: Path) -> Path:
+    return path.parent / (path.stem + MANIFEST_SUFFIX)
+
+
+def shard_path(path: Path, index: int, num_shards: int) -> Path:
+    return path.parent / f'{path.stem}.shard{index:03d}-of{num_shards:03d}.h5'
+
+
+def shard_of(name: str, num_shards: int) -> int:
+    '''Route a name to a shard, consistently across processes.'''
+    return zlib.crc32(name.encode()) % num_shards
+
+
+def is_manifest(path: Path) -> bool:
+    return str(path).endswith(MANIFEST_SUFFIX)
+
+
+def read_manifest(path: Path) -> Tuple[List[Path], Dict[str, Path]]:
+    return _read_manifest(str(path), os.stat(str(path)).st_mtime)
+
+
+@functools.lru_cache(maxsize=8)
+def _read_manifest(path: str, mtime: float):
+    with open(path, 'r') as f:
+        manifest = json.load(f)
+    shards = [Path(path).parent / s for s in manifest['shards']]
+    name2shard = {n: shards[i] for n, i in manifest['names'].items()}
+    return shards, name2shard
+
+
+def shard_marker_path(shard: Path) -> Path:
+    return shard.with_suffix('.names.json')
+
+
+def mark_shard(shard: Path, complete: bool = True):
+    '''Mark a shard as complete, with the list of its names, or as being
+    written. File locks are unreliable on network file systems, so only the
+    marker tells whether another process has finished writing a shard.
+    '''
+    marker = shard_marker_path(shard)
+    if not complete:
+        if marker.exists():
+            marker.unlink()
+        return
+    tmp_path = marker.with_suffix(f'.{os.getpid()}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(list_h5_names(shard), f)
+    os.replace(tmp_path, marker)  # atomic for concurrent readers
+
+
+def write_manifest(path: Path, num_shards: int) -> bool:
+    '''Write the manifest of a sharded store if all its shards are marked
+    as complete. Returns False if some shards are missing or still being
+    written.
+    '''
+    shards = [shard_path(path, i, num_shards) for i in range(num_shards)]
+    names = {}
+    for i, shard in enumerate(shards):
+        try:
+            with open(shard_marker_path(shard), 'r') as f:
+                names.update({n: i for n in json.load(f)})
+        except FileNotFoundError:
+            return False
+    manifest = {'shards': [s.name for s in shards], 'names': names}
+    tmp_path = manifest_path(path).with_suffix(f'.{os.getpid()}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path(path))  # atomic for concurrent writers
+    return True
+
+
+def resolve_h5_path(path: Path, name: str) -> Path:
+    '''Find the HDF5 file that contains a name in a file or manifest.'''
+    if is_manifest(path):
+        return read_manifest(path)[1][name]
+    return path
+
+
+def expand_h5_paths(paths: Union[Path, List[Path]]) -> List[Path]:
+    '''Replace the manifests of sharded stores by their shards.'''
+    if isinstance(paths, (str, Path)):
+        paths = [paths]
+    expanded = []
+    for path in paths:
+        if is_manifest(path):
+            expanded += read_manifest(path)[0]
+        else:
+            expanded.append(Path(path))
+    return expanded
+
+
+def quantize_descriptors(desc: np.ndarray, method: str = 'int8'
+                         ) -> Tuple[np.ndarray, Dict]:
+    '''Quantize descriptors to int8 with a single scale per image.
+    The parameters are returned as attributes of the dataset, such that
+    read_array dequantizes transparently.
+    '''
+    if method != 'int8':
+        raise ValueError(f'Unknown quantization method: {method}.')
+    desc = desc.astype(np.float32)
+    scale = np.float32(np.abs(desc).max() / 127) if desc.size else 0
+    if scale == 0:
+        scale = np.float32(1)
+    quantized = np.round(desc / scale).clip(-127, 127).astype(np.int8)
+    return quantized, {'quantization': method, 'scale': scale}
+
+
+def read_array(dset: h5py.Dataset) -> np.ndarray:
+    '''Read a dataset and dequantize it if needed.'''
+    array = dset.__array__()
+    if dset.attrs.get('quantization') == 'int8':
+        array = array.astype(np.float32) * dset.attrs['scale']
+    return array
+
+
+def read_stacked(names: List[str], paths: List[Path],
+                 key: str) -> np.ndarray:
+    '''Stack a dataset of each image, read from the file at the same index
+    in paths. Each file is opened only once.'''
+    arrays = []
+    fds = {}
+    try:
+        for name, path in zip(names, paths):
+            if path not in fds:
+                fds[path] = h5py.File(str(path), 'r')
+            arrays.append(read_array(fds[path][name][key]))
+    finally:
+        for fd in fds.values():
+            fd.close()
+    return np.stack(arrays, 0)
+
+
 def get_keypoints(path: Path, name: str,
                   return_uncertainty: bool = False) -> np.ndarray:
-    with h5py.File(str(path), 'r') as hfile:
+    with h5py.File(str(resolve_h5_path(path, name)), 'r') as hfile:
         dset = hfile[name]['keypoints']
         p = dset.__array__()
         uncertainty = dset.attrs.get('uncertainty')
@@ -71,3 +283,226 @@ def get_matches(path: Path, name0: str, name1: str) -> Tuple[np.ndarray]:
         matches = np.flip(matches, -1)
     scores = scores[idx]
     return matches, scores
+
+
+def get_storage_options(storage: Optional[Union[str, Dict]]) -> Dict:
+    if storage is None:
+        return {}
+    if isinstance(storage, str):
+        if storage not in storage_profiles:
+            raise ValueError(f'Unknown storage profile: {storage}.')
+        return storage_profiles[storage]
+    return storage
+
+
+def dataset_options(data: np.ndarray, options: Dict) -> Dict:
+    if data.ndim == 0 or data.size == 0:  # cannot be chunked
+        return {}
+    options = dict(options)
+    chunks = options.get('chunks')
+    if isinstance(chunks, (tuple, list)):
+        if len(chunks) == data.ndim:
+            options['chunks'] = tuple(
+                max(1, min(c, s)) for c, s in zip(chunks, data.shape))
+        else:
+            options['chunks'] = True
+    return options
+
+
+class FeatureReader:
+    '''Read the groups of datasets of images from HDF5 files that are kept
+    open for the whole lifetime of the reader. The decoded groups, optionally
+    transformed, e.g. to tensors on a device, are kept in a cache that evicts
+    the least recently used groups beyond max_bytes. Groups can be read
+    from multiple threads, which only wait for each other to read the files.
+    '''
+    def __init__(self, max_bytes: float = 1e9, transform=None):
+        self.max_bytes = max_bytes
+        self.transform = transform
+        self.lock = threading.Lock()
+        self.fds = {}
+        self.cache = collections.OrderedDict()
+        self.size = 0
+        self.hits = self.misses = 0
+        self.bytes_read = 0
+
+    def read(self, path: Path, name: str) -> Dict:
+        key = (path, name)
+        with self.lock:
+            if key in self.cache:
+                self.hits += 1
+                self.cache.move_to_end(key)
+                return self.cache[key][0]
+            self.misses += 1
+            if path not in self.fds:
+                self.fds[path] = h5py.File(str(path), 'r')
+            data = {}
+            for k, dset in self.fds[path][name].items():
+                data[k] = read_array(dset)
+                self.bytes_read += dset.id.get_storage_size()
+        if self.transform is not None:
+            data = self.transform(data)
+        size = sum(v.nbytes for v in data.values())
+        if size <= self.max_bytes:
+            with self.lock:
+                if key not in self.cache:
+                    self.cache[key] = (data, size)
+                    self.size += size
+                while self.size > self.max_bytes:
+                    _, (_, evicted) = self.cache.popitem(last=False)
+                    self.size -= evicted
+        return data
+
+    def summary(self) -> str:
+        total = max(self.hits + self.misses, 1)
+        return (f'feature cache hit rate {100*self.hits/total:.1f}%, '
+                f'{self.bytes_read/1e6:.1f} MB read from disk')
+
+    def close(self):
+        self.cache.clear()
+        self.size = 0
+        for fd in self.fds.values():
+            fd.close()
+        self.fds = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def limit_heap_fragmentation(threshold: int = 1 << 20) -> bool:
+    '''Allocate the buffers larger than threshold bytes with mmap, such
+    that they are returned to the system when freed. By default, glibc
+    raises this threshold dynamically, and the buffers of the features
+    decoded by several threads then fragment the heap: the memory usage of
+    the process grows by GBs. This is equivalent to MALLOC_MMAP_THRESHOLD_,
+    which takes precedence, and applies to the whole process. Returns False
+    if the allocator is not glibc.'''
+    if 'MALLOC_MMAP_THRESHOLD_' in os.environ:
+        return True
+    try:
+        libc = ctypes.CDLL('libc.so.6')
+        return libc.mallopt(-3, threshold) == 1  # M_MMAP_THRESHOLD
+    except (OSError, AttributeError):
+        return False
+
+
+def prefetch(func: Callable, items: Iterable, num_workers: int = 0,
+             depth: int = 16) -> Iterator:
+    '''Yield func(item) for each item, in order, while worker threads already
+    compute the results of the next depth items, e.g. read their features.
+    '''
+    if num_workers == 0:
+        yield from map(func, items)
+        return
+    with ThreadPoolExecutor(num_workers) as executor:
+        futures = collections.deque()
+        try:
+            for item in items:
+                futures.append(executor.submit(func, item))
+                if len(futures) > depth:
+                    yield futures.popleft().result()
+            while len(futures) > 0:
+                yield futures.popleft().result()
+        finally:  # the consumer stopped early
+            for future in futures:
+                future.cancel()
+
+
+class FeatureWriter:
+    '''Write groups of datasets to an HDF5 file from a background thread.
+    The file is kept open for the whole lifetime of the writer and writes are
+    queued, such that the caller does not wait for the disk unless the queue
+    is full. An error raised by the writing thread is re-raised by all the
+    next calls to write and by close, and the following writes are dropped,
+    such that the file has no silent holes.
+    '''
+    def __init__(self, path: Path, queue_size: int = 64,
+                 flush_interval: float = 30.,
+                 storage: Optional[Union[str, Dict]] = None):
+        self.path = path
+        self.storage = get_storage_options(storage)
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.fd = h5py.File(str(path), 'a')
+        self.names = read_name_index(self.fd)
+        if self.names is None:
+            self.names = list_h5_names_walk(self.fd)
+            append_name_index(self.fd, self.names)
+        self.names = set(self.names)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def write(self, name: str, data: Dict[str, np.ndarray],
+              attrs: Optional[Dict[str, Dict]] = None):
+        self._check_error()
+        self.queue.put((name, data, attrs or {}))
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.fd.close()
+        self._check_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _check_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        last_flush = time.time()
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue  # drain the queue such that the caller never blocks
+            try:
+                self._write(*item)
+            except Exception as error:
+                self.error = error
+            if time.time() - last_flush > self.flush_interval:
+                self.fd.flush()
+                last_flush = time.time()
+        self.fd.flush()
+
+    def _write(self, name, data, attrs):
+        fd = self.fd
+        try:
+            if name in fd:
+                del fd[name]
+            grp = fd.create_group(name)
+            for k, v in data.items():
+                grp.create_dataset(
+                    k, data=v, **dataset_options(v, self.storage))
+            for k, v in attrs.items():
+                grp[k].attrs.update(v)
+            if name not in self.names:
+                append_name_index(fd, [name])
+                self.names.add(name)
+        except OSError as error:
+            if 'No space left on device' in error.args[0]:
+                logger.error(
+                    'Out of disk space: storing features on disk can take '
+                    'significant space, did you enable the as_half flag?')
+                if name in fd:
+                    del fd[name]
+            raise error
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Add the name index to feature or match files.')
+    parser.add_argument('paths', type=Path, nargs='+')
+    args = parser.parse_args()
+    for path in args.paths:
+        add_name_index(path)
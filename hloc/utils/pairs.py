@@ -0,0 +1,145 @@
+from typing import Dict, List, Optional, Tuple
+from pathlib import Path
+import argparse
+import collections
+import random
+import h5py
+
+from .. import logger
+from .parsers import parse_retrieval
+from .io import list_h5_names, expand_h5_paths
+
+
+def schedule_pairs(pairs: List[Tuple[str, str]],
+                   capacity: Optional[int] = None) -> List[Tuple[str, str]]:
+    '''Reorder pairs such that consecutive pairs share their images.
+    The pairs of an anchor image are scheduled together, such that the anchor
+    is read once. Images are anchored in the order in which they are first
+    visited, as in a breadth-first traversal of the pair graph, which keeps
+    the working set small, but images that are still in a LRU cache of
+    capacity images are preferred. The neighbors of an anchor that are cached
+    come first, before they are evicted. The orientation of the pairs is
+    preserved. The cached images with pairs are tracked along with the cache,
+    such that selecting an anchor takes a constant time.
+    '''
+    adjacency = collections.defaultdict(list)
+    for i, (name0, name1) in enumerate(pairs):
+        adjacency[name0].append((name1, i))
+        adjacency[name1].append((name0, i))
+    degree = {n: len(adj) for n, adj in adjacency.items()}
+    by_degree = sorted(degree, key=lambda n: degree[n])
+    next_start = 0
+    queue = collections.OrderedDict()  # images with pairs, in visit order
+    cache = collections.OrderedDict()  # simulated LRU cache
+    ready = collections.OrderedDict()  # images with pairs that are cached
+    done = [False] * len(pairs)
+    order = []
+
+    def touch(name):
+        cache[name] = None
+        cache.move_to_end(name)
+        if capacity is not None and len(cache) > capacity:
+            evicted, _ = cache.popitem(last=False)
+            ready.pop(evicted, None)
+        if degree[name] == 0:
+            queue.pop(name, None)
+            ready.pop(name, None)
+        else:
+            queue.setdefault(name, None)
+            ready.setdefault(name, None)
+
+    while len(order) < len(pairs):
+        if len(ready) > 0:
+            anchor = next(iter(ready))
+        elif len(queue) > 0:
+            anchor = next(iter(queue))
+        else:
+            while degree[by_degree[next_start]] == 0:
+                next_start += 1
+            anchor = by_degree[next_start]
+        touch(anchor)
+
+        neighbors = [(n, i) for n, i in adjacency[anchor] if not done[i]]
+        neighbors.sort(key=lambda x: (x[0] not in cache, degree[x[0]]))
+        for name, i in neighbors:
+            if done[i]:  # self-pairs are listed twice
+                continue
+            done[i] = True
+            order.append(pairs[i])
+            degree[anchor] -= 1
+            degree[name] -= 1
+            touch(name)
+        adjacency[anchor] = []
+        queue.pop(anchor, None)
+        ready.pop(anchor, None)
+    return order
+
+
+def count_reads(pairs: List[Tuple[str, str]], capacity: int) -> List[str]:
+    '''The images read from disk when the pairs are processed in this order
+    with a LRU cache of capacity images.'''
+    cache = collections.OrderedDict()
+    reads = []
+    for pair in pairs:
+        for name in pair:
+            if name in cache:
+                cache.move_to_end(name)
+                continue
+            reads.append(name)
+            cache[name] = None
+            if len(cache) > capacity:
+                cache.popitem(last=False)
+    return reads
+
+
+def read_unique_pairs(pairs_path: Path) -> List[Tuple[str, str]]:
+    pairs = set()
+    for q, rs in parse_retrieval(pairs_path).items():
+        for r in rs:
+            if (r, q) not in pairs:
+                pairs.add((q, r))
+    return sorted(pairs)
+
+
+def feature_sizes(paths: List[Path]) -> Dict[str, int]:
+    '''The size on disk of the features of each image.'''
+    sizes = {}
+    for path in expand_h5_paths(paths):
+        with h5py.File(str(path), 'r') as fd:
+            for name in list_h5_names(path):
+                sizes[name] = sum(dset.id.get_storage_size()
+                                  for dset in fd[name].values())
+    return sizes
+
+
+def main(pairs_path: Path, features: Path, capacities: List[int]):
+    '''Report the feature bytes read per pair for different pair orders.'''
+    pairs = read_unique_pairs(pairs_path)
+    sizes = feature_sizes(features)
+    random.Random(0).shuffle(pairs)
+    logger.info('%d unique pairs of %d images, %.1f kB of features per image.',
+                len(pairs), len({n for p in pairs for n in p}),
+                sum(sizes.values()) / len(sizes) / 1e3)
+    for capacity in capacities:
+        orders = {
+            'unordered': pairs,
+            'sorted': sorted(pairs),
+            'scheduled': schedule_pairs(pairs, capacity),
+        }
+        for label, order in orders.items():
+            reads = count_reads(order, capacity)
+            logger.info('capacity %6d, %-9s: %6.2f reads/pair, '
+                        '%8.1f kB/pair', capacity, label,
+                        len(reads) / len(pairs),
+                        sum(sizes[n] for n in reads) / len(pairs) / 1e3)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the feature reads of the pair scheduling.')
+    parser.add_argument('--pairs', type=Path, required=True)
+    parser.add_argument('--features', type=Path, required=True)
+    parser.add_argument('--capacities', type=int, nargs='+',
+                        default=[16, 128, 1024])
+    args = parser.parse_args()
+    main(args.pairs, args.features, args.capacities)
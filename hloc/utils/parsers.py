@@ -2,7 +2,6 @@ from pathlib import Path
 import logging
 import numpy as np
 from collections import defaultdict
-import pycolmap
 
 logger = logging.getLogger(__name__)
 
@@ -18,6 +17,7 @@ def parse_image_list(path, with_intrinsics=False):
             if with_intrinsics:
                 model, width, height, *params = data
                 params = np.array(params, float)
+                import pycolmap
                 cam = pycolmap.Camera(model, int(width), int(height), params)
                 images.append((name, cam))
             else:
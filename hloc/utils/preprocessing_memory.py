@@ -0,0 +1,54 @@
+from typing import Dict, List
+from pathlib import Path
+import argparse
+import tracemalloc
+
+from .. import logger
+from ..extract_features import ImageDataset, load_image, preprocess_image
+
+# Options of ImageDataset that trade accuracy for memory.
+default_variants = {
+    'default': {},
+    'resize_uint8': {'resize_uint8': True},
+    'resize_uint8+reduced_decode': {
+        'resize_uint8': True, 'reduced_decode': True},
+}
+
+
+def peak_memory(path: Path, conf: Dict) -> int:
+    '''Peak allocation, in bytes, of reading and preprocessing an image,
+    as in a worker of the loader that handles one image at a time.'''
+    conf = ImageDataset(path.parent, conf, [path.name]).conf
+    tracemalloc.start()
+    try:
+        image, size = load_image(path, conf)
+        preprocess_image(image, size, conf)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main(image_dir: Path, resize_max: int, grayscale: List[bool],
+         num_images: int = 10):
+    '''Report the peak memory per image of each preprocessing variant.'''
+    paths = ImageDataset(image_dir, {}).names[:num_images]
+    for gray in grayscale:
+        for label, variant in default_variants.items():
+            conf = {'grayscale': gray, 'resize_max': resize_max, **variant}
+            peaks = [peak_memory(image_dir / p, conf) for p in paths]
+            logger.info('%-9s %-28s: mean %7.1f MB, max %7.1f MB',
+                        'grayscale' if gray else 'color', label,
+                        sum(peaks) / len(peaks) / 1e6, max(peaks) / 1e6)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the peak memory of the image preprocessing.')
+    parser.add_argument('--image_dir', type=Path, required=True)
+    parser.add_argument('--resize_max', type=int, default=1024)
+    parser.add_argument('--num_images', type=int, default=10)
+    parser.add_argument('--color', action='store_true',
+                        help='Also report color images')
+    args = parser.parse_args()
+    main(args.image_dir, args.resize_max,
+         [True, False] if args.color else [True], args.num_images)
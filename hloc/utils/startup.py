@@ -0,0 +1,53 @@
+from typing import List
+import argparse
+import subprocess
+import sys
+import time
+
+from .. import logger
+
+# The command-line scripts of hloc.
+default_modules = [
+    'hloc', 'hloc.extract_features', 'hloc.match_features',
+    'hloc.pairs_from_exhaustive', 'hloc.pairs_from_covisibility',
+    'hloc.pairs_from_poses', 'hloc.pairs_from_retrieval',
+    'hloc.triangulation', 'hloc.reconstruction', 'hloc.localize_sfm',
+    'hloc.localize_inloc', 'hloc.colmap_from_nvm',
+    'hloc.compress_global_features', 'hloc.merge_features',
+]
+
+
+def time_command(args: List[str], repeats: int) -> float:
+    '''Best wall time of a command in a new interpreter, in seconds.'''
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.time()
+        subprocess.run([sys.executable] + args, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        best = min(best, time.time() - start)
+    return best
+
+
+def main(modules: List[str], repeats: int = 3):
+    '''Report the time to import each module and to print the help of its
+    command-line interface, in a new interpreter each time.'''
+    baseline = time_command(['-c', 'pass'], repeats)
+    logger.info('Python startup: %.2fs, not included below.', baseline)
+    for module in modules:
+        import_time = time_command(['-c', f'import {module}'], repeats)
+        help_time = None
+        if module != 'hloc':
+            help_time = time_command(['-m', module, '--help'], repeats)
+        logger.info('%-32s import %.2fs, --help %s', module,
+                    import_time - baseline, '-' if help_time is None
+                    else f'{help_time - baseline:.2f}s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the startup time of the hloc scripts.')
+    parser.add_argument('--modules', type=str, nargs='+',
+                        default=default_modules)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+    main(args.modules, args.repeats)
@@ -0,0 +1,140 @@
+from typing import List, Optional, Tuple
+from pathlib import Path
+import argparse
+import random
+import tempfile
+import time
+import h5py
+
+from .. import logger
+from .io import (
+    list_h5_names, read_array, FeatureWriter, storage_profiles,
+    quantize_descriptors, get_matches)
+
+
+def rewrite(path: Path, output: Path, storage: str):
+    '''Copy the groups of a feature or match file with a storage profile.
+    The datasets are copied as stored, e.g. still quantized, with their
+    attributes.'''
+    with h5py.File(str(path), 'r') as fd, \
+            FeatureWriter(output, storage=storage) as writer:
+        for name in list_h5_names(path):
+            grp = fd[name]
+            writer.write(name, {k: grp[k][()] for k in grp},
+                         {k: dict(grp[k].attrs) for k in grp})
+
+
+def read_latency(path: Path, names: List[str]) -> float:
+    '''Average time to read and decode all the datasets of an image.
+    The file is likely in the page cache, so this is mostly decoding.'''
+    with h5py.File(str(path), 'r') as fd:
+        start = time.time()
+        for name in names:
+            for dset in fd[name].values():
+                read_array(dset)
+        return (time.time() - start) / len(names)
+
+
+def main(path: Path, profiles: List[str], num_images: int = 1000,
+         output_dir: Optional[Path] = None):
+    '''Report the file size and the read latency of each storage profile.'''
+    names = list_h5_names(path)
+    names = random.Random(0).sample(names, min(num_images, len(names)))
+    with tempfile.TemporaryDirectory(dir=output_dir) as tmp_dir:
+        for profile in profiles:
+            output = Path(tmp_dir, f'{path.stem}-{profile}.h5')
+            rewrite(path, output, profile)
+            read_latency(output, names[:10])  # warm up
+            logger.info('%-10s: %8.1f MB, %6.3f ms/image', profile,
+                        output.stat().st_size / 1e6,
+                        read_latency(output, names) * 1e3)
+            output.unlink()
+
+
+def quantize_file(path: Path, output: Path):
+    '''Copy a feature file with its local descriptors quantized to int8,
+    as written by extract_features with quantize='int8'.'''
+    with h5py.File(str(path), 'r') as fd, FeatureWriter(output) as writer:
+        for name in list_h5_names(path):
+            grp = fd[name]
+            data = {k: grp[k][()] for k in grp}
+            attrs = {k: dict(grp[k].attrs) for k in grp}
+            if 'descriptors' in data:
+                data['descriptors'], quantization = quantize_descriptors(
+                    read_array(grp['descriptors']))
+                attrs['descriptors'].update(quantization)
+            writer.write(name, data, attrs)
+
+
+def count_matches(pairs: List[Tuple[str, str]], reference: Path,
+                  other: Path) -> Tuple[int, int, int]:
+    '''Number of matches in the reference and other match files, and of
+    matches in both.'''
+    num_ref = num_other = num_common = 0
+    for name0, name1 in pairs:
+        ref = {tuple(m) for m in get_matches(reference, name0, name1)[0]}
+        oth = {tuple(m) for m in get_matches(other, name0, name1)[0]}
+        num_ref, num_other = num_ref + len(ref), num_other + len(oth)
+        num_common += len(ref & oth)
+    return num_ref, num_other, num_common
+
+
+def compare_int8(path: Path, pairs_path: Path, matchers: List[str],
+                 num_images: int = 1000, output_dir: Optional[Path] = None):
+    '''Compare a feature file with its copy with int8 local descriptors:
+    file size, read latency, and matches of each matcher configuration.'''
+    from .. import match_features
+    from .parsers import parse_retrieval
+
+    names = list_h5_names(path)
+    names = random.Random(0).sample(names, min(num_images, len(names)))
+    pairs = [(q, r) for q, rs in parse_retrieval(pairs_path).items()
+             for r in rs]
+    with tempfile.TemporaryDirectory(dir=output_dir) as tmp_dir:
+        paths = {'original': path,
+                 'int8': Path(tmp_dir, f'{path.stem}-int8.h5')}
+        quantize_file(path, paths['int8'])
+        for label, p in paths.items():
+            read_latency(p, names[:10])  # warm up
+            logger.info('%-8s: %8.1f MB, %6.3f ms/image', label,
+                        p.stat().st_size / 1e6, read_latency(p, names) * 1e3)
+        for conf in matchers:
+            matches = {}
+            for label, p in paths.items():
+                matches[label] = Path(tmp_dir, f'matches-{conf}-{label}.h5')
+                match_features.main(
+                    match_features.confs[conf], pairs_path, p,
+                    matches=matches[label])
+            num_ref, num_int8, num_common = count_matches(
+                pairs, matches['original'], matches['int8'])
+            logger.info('%s: %d original and %d int8 matches, recall '
+                        '%.1f%%, precision %.1f%% w.r.t. the original.',
+                        conf, num_ref, num_int8,
+                        100 * num_common / max(num_ref, 1),
+                        100 * num_common / max(num_int8, 1))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the storage profiles on a feature or '
+        'match file.')
+    parser.add_argument('path', type=Path)
+    parser.add_argument('--profiles', type=str, nargs='+',
+                        choices=list(storage_profiles.keys()),
+                        default=list(storage_profiles.keys()))
+    parser.add_argument('--num_images', type=int, default=1000,
+                        help='Number of images of which the reads are timed')
+    parser.add_argument('--output_dir', type=Path,
+                        help='Where the rewritten files are temporarily stored')
+    parser.add_argument('--int8_pairs', type=Path,
+                        help='Instead, compare the local features with their '
+                        'int8 quantization, matched on these pairs')
+    parser.add_argument('--matchers', type=str, nargs='+',
+                        default=['NN-mutual', 'NN-ratio'],
+                        help='Configurations of match_features')
+    args = parser.parse_args()
+    if args.int8_pairs is None:
+        main(args.path, args.profiles, args.num_images, args.output_dir)
+    else:
+        compare_int8(args.path, args.int8_pairs, args.matchers,
+                     args.num_images, args.output_dir)
@@ -1,4 +1,3 @@
-from torch._six import string_classes
 import collections.abc as collections
 import torch
 
@@ -6,7 +5,7 @@ import torch
 def map_tensor(input_, func):
     if isinstance(input_, torch.Tensor):
         return func(input_)
-    elif isinstance(input_, string_classes):
+    elif isinstance(input_, str):
         return input_
     elif isinstance(input_, collections.Mapping):
         return {k: map_tensor(sample, func) for k, sample in input_.items()}